@@ -0,0 +1,20 @@
+# Gunicorn settings for the receiver, run from this directory with:
+#   gunicorn -c gunicorn.conf.py server:app
+#
+# Upload, job and image state lives in module-level dicts in server.py, so a
+# single worker process serves every request and concurrency comes from threads.
+import os
+
+bind = "0.0.0.0:5000"
+workers = 1
+worker_class = "gthread"
+# Every in-flight chunk or single-file upload holds a thread until its body is
+# written, so scale with the machine rather than a fixed count
+threads = max(8, 4 * (os.cpu_count() or 1))
+
+# Keep connections open between a sender's chunk requests
+keepalive = 30
+
+# The worker heartbeat file is touched constantly; keep it off the disk
+if os.path.isdir("/dev/shm"):
+    worker_tmp_dir = "/dev/shm"
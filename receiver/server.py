@@ -1,47 +1,331 @@
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, Request, Response, request, jsonify, send_file
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from werkzeug.utils import secure_filename
+import errno
+import hashlib
+import logging
 import os
+import queue
+import shutil
 import uuid
-import json
 import subprocess
+import tarfile
+import tempfile
+import threading
 import time
 
+# Multipart file parts up to this size stay in memory while the form is parsed.
+# Werkzeug spools anything over 500KB to a temporary file, so every /data chunk
+# was written to disk once by the parser and again into the combined file.
+# Larger parts spool next to the staging files, so they can be copied in-kernel
+MULTIPART_SPOOL_SIZE = 8 * 1024 * 1024
+
+class UploadRequest(Request):
+    """Request whose multipart file parts are spooled to disk only past MULTIPART_SPOOL_SIZE"""
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return tempfile.SpooledTemporaryFile(max_size=MULTIPART_SPOOL_SIZE, mode="rb+", dir=".")
+
 app = Flask(__name__)
+app.request_class = UploadRequest
+
+# Upload, build and eviction events are logged at info level and failures as
+# warnings. Per-chunk events are logged at debug level so they cost nothing by
+# default; set LOG_LEVEL=DEBUG to see them, or LOG_LEVEL=WARNING for errors only
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO").upper())
+logger = logging.getLogger("receiver")
 
-# Dictionary to track chunked uploads
+# Dictionary to track chunked uploads. chunk_tracker_lock guards adding and
+# removing entries; each entry's own lock guards its bitmap and count
 chunk_tracker = {}
+chunk_tracker_lock = threading.Lock()
 
-# Dictionary to track exported image chunks available for download
+# Chunked uploads that completed in the last COMPLETED_UPLOAD_GRACE seconds, by
+# upload key, also guarded by chunk_tracker_lock. A chunk retried after its upload
+# completed (its 202 lost on the way back) gets the upload's job instead of
+# starting a new upload. Recognised by the chunk's SHA-256, as upload keys are reused
+completed_uploads = {}
+COMPLETED_UPLOAD_GRACE = 5 * 60
+
+# Dictionary to track exported image chunks available for download.
+# image_chunks_lock guards iterating over it and removing entries
 image_chunks = {}
+image_chunks_lock = threading.Lock()
+
+# Chunked uploads that receive no chunk for this long, and exported images that
+# are never marked downloaded, are evicted so abandoned transfers don't keep their
+# memory, staging files and chunk files forever. Checked every EVICTION_INTERVAL
+MAX_UPLOAD_IDLE = 60 * 60
+MAX_IMAGE_AGE = 24 * 60 * 60
+EVICTION_INTERVAL = 5 * 60
+
+# Background extract/build/export jobs by upload ID. Threads rather than
+# processes: the jobs update the in-process trackers above and spend their
+# time waiting on tar and docker subprocesses
+job_executor = ThreadPoolExecutor(max_workers=os.cpu_count())
+jobs = {}
+
+# Extraction directories in use, combined tar files and build logs created by this
+# server, so /status and /cleanup don't have to scan the working directory
+extracted_dirs = set()
+received_tars = set()
+build_logs = set()
+
+# Buffer size used when streaming upload bodies and copying files to disk
+STREAM_BUFFER_SIZE = 2 * 1024 * 1024
+
+# Chunk size and upload concurrency suggested to senders through /config. Chunks
+# are written in parallel at their own offsets, so throughput grows with the
+# number of connections until the disk or the gunicorn thread pool saturates
+SUGGESTED_CHUNK_SIZE = 8 * 1024 * 1024
+MAX_CONCURRENT_CHUNKS = min(16, 2 * (os.cpu_count() or 1))
+
+# Long-lived BuildKit builder shared by every build, and its persistent layer cache.
+# The cache has a directory per platform and Dockerfile; one that no build has used
+# for BUILDX_CACHE_MAX_AGE is pruned by the eviction loop. buildx_cache_lock guards
+# buildx_caches_in_use, the number of running builds using each directory
+BUILDX_BUILDER = "cicd"
+BUILDX_CACHE_DIR = "/var/cache/buildx"
+BUILDX_CACHE_MAX_AGE = 7 * 24 * 60 * 60
+buildx_builder_lock = threading.Lock()
+buildx_builder_ready = False
+buildx_caches_in_use = {}
+buildx_cache_lock = threading.Lock()
+
+# Docker platform for each architecture an upload can ask for. "unknown" is what an
+# upload that names no architecture gets, and builds for amd64
+ARCHITECTURE_PLATFORMS = {
+    "x86": "linux/386",
+    "x64": "linux/amd64",
+    "arm": "linux/arm/v7",
+    "arm64": "linux/arm64",
+    "unknown": "linux/amd64"
+}
+
+# Accepted upload formats. zstd decompresses several times faster than gzip,
+# and plain tar skips decompression entirely for senders on a fast link
+ARCHIVE_EXTENSIONS = (".tar.gz", ".tar.zst", ".tar")
+
+# Uploads are unpacked in-process with tarfile. The "tar" filter refuses absolute
+# and escaping member paths, like GNU tar does. Pythons without extraction filters
+# (before 3.10.12/3.11.4) get the same checks from check_member_path instead
+TAR_EXTRACT_KWARGS = {"filter": "tar"} if hasattr(tarfile, "tar_filter") else {}
+
+# Parallel gzip, used to decompress .tar.gz uploads when it is installed
+PIGZ_PATH = shutil.which("pigz")
+
+# Docker images built by this server, by image name. Recorded when a build
+# succeeds so /status can list them without shelling out to `docker images`
+built_images = {}
+built_images_lock = threading.Lock()
+
+# Extraction directories are handed out from a fixed pool and emptied when their
+# build finishes, rather than minting ./{upload_id} for every upload. Uploads
+# that arrive while the pool is exhausted get a one-off directory instead
+WORKDIR_ROOT = "./workdirs"
+WORKDIR_POOL_SIZE = 2 * (os.cpu_count() or 1)
+workdir_pool = queue.Queue()
+pooled_workdirs = set()
+# Guards extracted_dirs, so a directory is released at most once per acquire
+workdirs_lock = threading.Lock()
+
+# rm -rf removes an extracted source tree with unlinkat() in C, several times faster
+# than shutil.rmtree walking it in Python. rmtree remains the fallback (e.g. Windows)
+RM_PATH = shutil.which("rm")
+
+def remove_tree(path):
+    """Delete a directory tree, ignoring errors"""
+    if RM_PATH:
+        subprocess.run([RM_PATH, "-rf", "--", path], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    else:
+        shutil.rmtree(path, ignore_errors=True)
 
-def extract_tar_file(tar_file_path, extract_id):
-    """Extract tar file to a unique directory"""
+def init_workdir_pool():
+    """Create the pooled extraction directories, discarding anything left by a previous run"""
+    remove_tree(WORKDIR_ROOT)
+    for i in range(WORKDIR_POOL_SIZE):
+        workdir = os.path.join(WORKDIR_ROOT, str(i))
+        os.makedirs(workdir)
+        pooled_workdirs.add(workdir)
+        workdir_pool.put(workdir)
+
+init_workdir_pool()
+
+def acquire_workdir(upload_id):
+    """Take an empty extraction directory from the pool, or create a one-off one if none is free"""
     try:
-        # Create extraction directory with unique ID
-        extract_dir = f"./{extract_id}"
-        
-        # Create directory if it doesn't exist
-        os.makedirs(extract_dir, exist_ok=True)
+        workdir = workdir_pool.get_nowait()
+    except queue.Empty:
+        workdir = os.path.join(WORKDIR_ROOT, upload_id)
+        os.makedirs(workdir, exist_ok=True)
+    with workdirs_lock:
+        extracted_dirs.add(workdir)
+    return workdir
+
+def release_workdir(workdir):
+    """Empty an extraction directory and return it to the pool (one-off directories are removed)"""
+    # Releasing a directory twice would put it in the pool twice, and two uploads
+    # would then extract into it at once
+    with workdirs_lock:
+        if workdir not in extracted_dirs:
+            logger.warning("Not releasing %s, it is already released", workdir)
+            return
+        extracted_dirs.discard(workdir)
+    # Renaming the tree out of the way is O(1), so the directory can be reused (and a
+    # failed upload's request can return) without waiting for the recursive delete
+    discarded = f"{workdir}.{uuid.uuid4().hex[:8]}.discard"
+    try:
+        os.rename(workdir, discarded)
+    except OSError:
+        remove_tree(workdir)
+    else:
+        threading.Thread(target=remove_tree, args=(discarded,), daemon=True).start()
+    if workdir in pooled_workdirs:
+        os.makedirs(workdir, exist_ok=True)
+        workdir_pool.put(workdir)
+
+def is_escaping_path(path):
+    """True if a member path, relative to the extraction directory, is absolute or leads out of it"""
+    normalized = os.path.normpath(path)
+    return os.path.isabs(path) or normalized == ".." or normalized.startswith("../")
+
+def check_member_path(member):
+    """Refuse a tar member that would be written, or link, outside the extraction directory (raises TarError)"""
+    if is_escaping_path(member.name):
+        raise tarfile.TarError(f"Refusing to extract {member.name!r}: path is outside the extraction directory")
+    if member.issym():
+        # A symlink's target is relative to the directory the link is in
+        target = os.path.join(os.path.dirname(member.name), member.linkname)
+    elif member.islnk():
+        target = member.linkname
+    else:
+        target = None
+    if target is not None and (os.path.isabs(member.linkname) or is_escaping_path(target)):
+        raise tarfile.TarError(f"Refusing to extract {member.name!r}: link to {member.linkname!r} is outside the extraction directory")
+    if member.isdev():
+        raise tarfile.TarError(f"Refusing to extract {member.name!r}: device files are not allowed")
+
+def strip_first_component(members):
+    """Yield tar members with their leading path component removed, like --strip-components=1"""
+    for member in members:
+        parts = member.name.split('/', 1)
+        if len(parts) < 2 or not parts[1]:
+            continue
+        member.name = parts[1]
+        if member.islnk():
+            member.linkname = member.linkname.split('/', 1)[-1]
+        if not TAR_EXTRACT_KWARGS:
+            # No extraction filter on this Python, so fail closed here
+            check_member_path(member)
+        yield member
+
+def decompress_command(filename):
+    """Return the external decompressor command for an upload, or None to decompress in-process"""
+    if filename.endswith(".tar.zst"):
+        # tarfile can't decompress zstd
+        return ["zstd", "-dc"]
+    if filename.endswith(".tar.gz") and PIGZ_PATH:
+        return [PIGZ_PATH, "-dc", "-p", str(os.cpu_count() or 1)]
+    return None
+
+def feed_decompressor(fileobj, pipe):
+    """Copy an archive into a decompressor's stdin and close it (runs on its own thread)"""
+    try:
+        if isinstance(fileobj, ChunkedUploadReader):
+            # Staged chunks go from the staging file to the pipe in-kernel
+            fileobj.sendfile_to(pipe.fileno())
+        else:
+            shutil.copyfileobj(fileobj, pipe, STREAM_BUFFER_SIZE)
+    except Exception:
+        # A broken pipe or a dropped upload leaves the decompressor with truncated
+        # input, and its exit status and stderr say why
+        pass
+    finally:
+        try:
+            pipe.close()
+        except BrokenPipeError:
+            pass
+
+def extract_tar_in_process(fileobj, extract_dir, mode):
+    """Extract a tar stream into extract_dir with strip-components=1 (returns an error message or None)"""
+    # Stream mode reads members in order without seeking
+    try:
+        with tarfile.open(fileobj=fileobj, mode=mode) as tar:
+            tar.extractall(extract_dir, members=strip_first_component(tar), **TAR_EXTRACT_KWARGS)
+    except (tarfile.TarError, OSError) as e:
+        return str(e)
+    return None
+
+def extract_archive(fileobj, extract_dir, filename):
+    """Extract an archive read sequentially from fileobj into extract_dir with strip-components=1 (returns an error message or None)"""
+    command = decompress_command(filename)
+    if command is None:
+        return extract_tar_in_process(fileobj, extract_dir, 'r|' if filename.endswith(".tar") else 'r|gz')
+    
+    # Decompress in a separate process, fed from a helper thread while tarfile reads its output.
+    # stderr goes to a file so a chatty decompressor can't block
+    with tempfile.TemporaryFile() as stderr_file:
+        try:
+            process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=stderr_file)
+        except OSError as e:
+            return f"Could not run {command[0]}: {e}"
+        feeder = threading.Thread(target=feed_decompressor, args=(fileobj, process.stdin), daemon=True)
+        feeder.start()
         
-        # Extract tar file with strip-components=1
-        cmd = ["tar", "-xzf", tar_file_path, "-C", extract_dir, "--strip-components=1"]
+        extract_error = extract_tar_in_process(process.stdout, extract_dir, 'r|')
+        process.stdout.close()
+        if extract_error is not None:
+            # Stop the decompressor so the feeder isn't left blocked on a full pipe
+            process.kill()
+        feeder.join()
+        returncode = process.wait()
         
-        print(f"Extracting {tar_file_path} to {extract_dir}...")
-        result = subprocess.run(cmd, capture_output=True, text=True)
+        if returncode > 0:
+            stderr_file.seek(0)
+            return stderr_file.read().decode(errors="replace") or f"{command[0]} exited with status {returncode}"
+        return extract_error
+
+def extract_tar_stream(stream, extract_dir, filename):
+    """Extract a tar stream into an empty working directory as it is received"""
+    try:
+        logger.info("Extracting upload stream to %s", extract_dir)
+        extract_error = extract_archive(stream, extract_dir, filename)
         
-        if result.returncode == 0:
-            print(f"✓ Successfully extracted to {extract_dir}")
-            # Remove the tar file after successful extraction
-            os.remove(tar_file_path)
-            print(f"✓ Cleaned up tar file: {tar_file_path}")
+        if extract_error is None:
+            logger.info("Extracted upload to %s", extract_dir)
             return True, extract_dir
         else:
-            print(f"✗ Extraction failed: {result.stderr}")
-            return False, f"Extraction failed: {result.stderr}"
+            logger.warning("Extraction failed: %s", extract_error)
+            return False, f"Extraction failed: {extract_error}"
     
     except Exception as e:
-        print(f"✗ Error during extraction: {str(e)}")
+        logger.exception("Error during extraction")
         return False, f"Error during extraction: {str(e)}"
 
+def ensure_buildx_builder():
+    """Create the long-lived buildx builder the first time a build needs it"""
+    global buildx_builder_ready
+    with buildx_builder_lock:
+        if buildx_builder_ready:
+            return True, BUILDX_BUILDER
+        
+        inspect = subprocess.run(["docker", "buildx", "inspect", BUILDX_BUILDER], capture_output=True, text=True)
+        if inspect.returncode != 0:
+            logger.info("Creating buildx builder %s", BUILDX_BUILDER)
+            create_cmd = ["docker", "buildx", "create", "--name", BUILDX_BUILDER, "--driver", "docker-container", "--bootstrap"]
+            create = subprocess.run(create_cmd, capture_output=True, text=True)
+            if create.returncode != 0:
+                return False, f"Failed to create buildx builder: {create.stderr}"
+        
+        buildx_builder_ready = True
+        return True, BUILDX_BUILDER
+
+def read_log_tail(log_path, max_bytes=4096):
+    """Read the last max_bytes of a log file"""
+    with open(log_path, 'rb') as log_file:
+        log_file.seek(max(os.path.getsize(log_path) - max_bytes, 0))
+        return log_file.read().decode(errors="replace")
+
 def build_docker_image(extract_dir, architecture, upload_id):
     """Build Docker image for the specified architecture"""
     try:
@@ -54,129 +338,806 @@ def build_docker_image(extract_dir, architecture, upload_id):
         image_name = f"cicd-build-{architecture}-{upload_id[:8]}"
         
         # Map architecture names to Docker platform format
-        platform_map = {
-            "x86": "linux/386",
-            "x64": "linux/amd64", 
-            "arm": "linux/arm/v7",
-            "arm64": "linux/arm64"
-        }
+        platform = ARCHITECTURE_PLATFORMS.get(architecture, "linux/amd64")
+        
+        builder_success, builder_result = ensure_buildx_builder()
+        if not builder_success:
+            return False, builder_result
         
-        platform = platform_map.get(architecture, "linux/amd64")
+        # A local cache export replaces the directory's index with the last build's
+        # layers, so uploads of unrelated projects sharing one directory would keep
+        # evicting each other. Key the cache by platform and Dockerfile instead, so
+        # rebuilds of the same project reuse their own layers
+        with open(dockerfile_path, 'rb') as dockerfile:
+            dockerfile_digest = hashlib.sha256(dockerfile.read()).hexdigest()[:16]
+        cache_dir = os.path.join(BUILDX_CACHE_DIR, f"{platform.replace('/', '-')}-{dockerfile_digest}")
         
-        # Build Docker command
+        # Build Docker command, sharing the BuildKit layer cache across uploads.
+        # --load is needed because docker-container builders don't load images locally
         cmd = [
             "docker", "buildx", "build",
+            "--builder", BUILDX_BUILDER,
             "--platform", platform,
+            "--cache-from", f"type=local,src={cache_dir}",
+            "--cache-to", f"type=local,dest={cache_dir},mode=max",
             "-t", image_name,
+            "--load",
             extract_dir
         ]
         
-        print(f"Building Docker image {image_name} for platform {platform}...")
-        print(f"Command: {' '.join(cmd)}")
+        logger.info("Building Docker image %s for platform %s", image_name, platform)
+        logger.debug("Command: %s", " ".join(cmd))
         
-        # Run docker build
-        result = subprocess.run(cmd, capture_output=True, text=True)
+        # Run docker build, streaming its output (BuildKit writes progress to
+        # stderr) to a log file instead of holding it in memory
+        build_log_path = f"./build_{upload_id[:8]}.log"
+        build_logs.add(build_log_path)
+        with buildx_cache_lock:
+            buildx_caches_in_use[cache_dir] = buildx_caches_in_use.get(cache_dir, 0) + 1
+        try:
+            with open(build_log_path, 'wb') as build_log:
+                result = subprocess.run(cmd, stdout=build_log, stderr=subprocess.STDOUT)
+        finally:
+            with buildx_cache_lock:
+                buildx_caches_in_use[cache_dir] -= 1
+                if not buildx_caches_in_use[cache_dir]:
+                    del buildx_caches_in_use[cache_dir]
+                # The directory's mtime records its last use for prune_buildx_caches
+                try:
+                    os.utime(cache_dir)
+                except OSError:
+                    pass
         
         if result.returncode == 0:
-            print(f"✓ Successfully built Docker image: {image_name}")
+            logger.info("Built Docker image %s", image_name)
+            with built_images_lock:
+                built_images[image_name] = {
+                    "name": image_name,
+                    "tag": "latest",
+                    "architecture": architecture,
+                    "upload_id": upload_id,
+                    "upload_id_short": upload_id[:8],
+                    "size": None,
+                    "created": time.time()
+                }
             return True, {
                 "image_name": image_name,
                 "platform": platform,
-                "build_output": result.stdout
+                "build_log": build_log_path
             }
         else:
-            print(f"✗ Docker build failed: {result.stderr}")
-            return False, f"Docker build failed: {result.stderr}"
+            build_output = read_log_tail(build_log_path)
+            logger.warning("Docker build of %s failed: %s", image_name, build_output)
+            return False, f"Docker build failed: {build_output}"
     
     except Exception as e:
-        print(f"✗ Error during Docker build: {str(e)}")
+        logger.exception("Error during Docker build")
         return False, f"Error during Docker build: {str(e)}"
 
+def sendfile_range(out_fd, in_fd, offset, count):
+    """Copy count bytes of in_fd starting at offset to out_fd, in-kernel where possible"""
+    copied = 0
+    while copied < count:
+        try:
+            sent = os.sendfile(out_fd, in_fd, offset + copied, count - copied)
+        except OSError as e:
+            if e.errno not in (errno.EINVAL, errno.ENOSYS):
+                raise
+            # sendfile can't write to this kind of file, copy through userspace
+            data = os.pread(in_fd, min(STREAM_BUFFER_SIZE, count - copied), offset + copied)
+            sent = os.write(out_fd, data) if data else 0
+        if sent == 0:
+            break
+        copied += sent
+    return copied
+
+def splice_from_pipe(out_fd, pipe_fd, count):
+    """Move up to count bytes from a pipe to out_fd, in-kernel where possible (returns fewer only at EOF)"""
+    copied = 0
+    # os.splice is Linux-only (and Python 3.10+)
+    use_splice = hasattr(os, "splice")
+    while copied < count:
+        moved = None
+        if use_splice:
+            try:
+                moved = os.splice(pipe_fd, out_fd, count - copied)
+            except OSError as e:
+                if e.errno != errno.EINVAL:
+                    raise
+                # splice can't write to this kind of file
+                use_splice = False
+        if moved is None:
+            # Copy through userspace
+            data = os.read(pipe_fd, min(STREAM_BUFFER_SIZE, count - copied))
+            moved = os.write(out_fd, data) if data else 0
+        if moved == 0:
+            break
+        copied += moved
+    return copied
+
 def export_and_split_docker_image(image_name, upload_id, chunk_size_mb=5):
     """Export Docker image and split it into chunks"""
+    chunk_files = []
     try:
-        # Export the Docker image to a tar file
-        export_filename = f"docker_image_{upload_id[:8]}.tar"
-        export_path = f"./{export_filename}"
-        
-        print(f"Exporting Docker image {image_name} to {export_path}...")
+        logger.info("Exporting Docker image %s into chunks", image_name)
         
-        # Export Docker image
-        export_cmd = ["docker", "save", "-o", export_path, image_name]
-        result = subprocess.run(export_cmd, capture_output=True, text=True)
-        
-        if result.returncode != 0:
-            return False, f"Failed to export Docker image: {result.stderr}"
-        
-        print(f"✓ Successfully exported Docker image to {export_path}")
-        
-        # Split the exported tar file into chunks
+        # Split the docker save stream into chunk files as it is produced, so the
+        # whole image is never written to disk and read back as one export tar
         chunk_size_bytes = int(chunk_size_mb * 1024 * 1024)
-        chunk_files = []
+        total_size = 0
         
-        with open(export_path, 'rb') as f:
-            chunk_num = 0
-            while True:
-                chunk_data = f.read(chunk_size_bytes)
-                if not chunk_data:
-                    break
-                
-                chunk_filename = f"image_chunk_{upload_id[:8]}_{chunk_num:03d}.tar"
-                chunk_path = f"./{chunk_filename}"
-                
-                with open(chunk_path, 'wb') as chunk_file:
-                    chunk_file.write(chunk_data)
-                
-                chunk_files.append(chunk_filename)
-                print(f"Created image chunk: {chunk_filename} ({len(chunk_data)} bytes)")
-                chunk_num += 1
+        with tempfile.TemporaryFile() as stderr_file:
+            process = subprocess.Popen(["docker", "save", image_name], stdout=subprocess.PIPE, stderr=stderr_file)
+            try:
+                pipe_fd = process.stdout.fileno()
+                chunk_num = 0
+                while True:
+                    chunk_filename = f"image_chunk_{upload_id[:8]}_{chunk_num:03d}.tar"
+                    chunk_path = f"./{chunk_filename}"
+                    
+                    # Move the chunk from the pipe into its file without copying it through Python.
+                    # It is listed before it is written, so a failure part way removes it too
+                    chunk_files.append(chunk_filename)
+                    with open(chunk_path, 'wb') as chunk_file:
+                        copied = splice_from_pipe(chunk_file.fileno(), pipe_fd, chunk_size_bytes)
+                    
+                    if not copied:
+                        os.remove(chunk_path)
+                        chunk_files.pop()
+                        break
+                    
+                    logger.debug("Created image chunk: %s (%d bytes)", chunk_filename, copied)
+                    total_size += copied
+                    chunk_num += 1
+                    if copied < chunk_size_bytes:
+                        break
+            finally:
+                # Closing the pipe first stops docker save if splitting failed part way
+                process.stdout.close()
+                returncode = process.wait()
+            
+            if returncode != 0:
+                for chunk_filename in chunk_files:
+                    os.remove(f"./{chunk_filename}")
+                stderr_file.seek(0)
+                return False, f"Failed to export Docker image: {stderr_file.read().decode(errors='replace')}"
         
-        # Remove the original export file
-        os.remove(export_path)
-        print(f"✓ Cleaned up export file: {export_path}")
+        logger.info("Exported Docker image %s into %d chunks", image_name, len(chunk_files))
         
         return True, {
             "chunk_files": chunk_files,
             "total_chunks": len(chunk_files),
-            "original_size": os.path.getsize(chunk_files[0]) * (len(chunk_files) - 1) + os.path.getsize(chunk_files[-1]) if chunk_files else 0
+            "chunk_size": chunk_size_bytes,
+            "original_size": total_size
         }
         
     except Exception as e:
-        print(f"✗ Error during Docker image export/split: {str(e)}")
+        logger.exception("Error during Docker image export/split")
+        for chunk_filename in chunk_files:
+            try:
+                os.remove(f"./{chunk_filename}")
+            except OSError:
+                pass
         return False, f"Error during Docker image export/split: {str(e)}"
 
-def combine_chunks(original_filename, total_chunks, upload_id):
-    """Combine all chunks into the original file"""
-    combined_file_path = f"./received_{original_filename}"
+def build_and_export_image(extract_dir, architecture, upload_id, filename, release_context=release_workdir):
+    """Build and export the Docker image for an extracted upload (runs on job_executor)"""
+    result = {
+        "id": upload_id,
+        "architecture": architecture,
+        "filename": filename,
+        "extracted_to": extract_dir
+    }
     
-    try:
-        # Verify all chunks exist before combining
-        missing_chunks = []
-        for i in range(total_chunks):
-            chunk_path = f"./temp_{upload_id}_chunk_{i}"
-            if not os.path.exists(chunk_path):
-                missing_chunks.append(i)
+    # Build Docker image for the specified architecture
+    build_success, build_result = build_docker_image(extract_dir, architecture, upload_id)
+    
+    # The build context is no longer needed once the image is built
+    release_context(extract_dir)
+    
+    if not build_success:
+        logger.warning("Docker build failed for %s: %s", filename, build_result)
+        result.update({
+            "status": "failed",
+            "message": "Upload extracted successfully, but Docker build failed",
+            "docker_build_error": build_result
+        })
+        return result
+    
+    result.update({
+        "docker_image": build_result["image_name"],
+        "platform": build_result["platform"]
+    })
+    
+    # Export and split the Docker image
+    export_success, export_result = export_and_split_docker_image(build_result["image_name"], upload_id)
+    
+    if not export_success:
+        logger.warning("Built Docker image for %s but export failed: %s", filename, export_result)
+        result.update({
+            "status": "failed",
+            "message": "Upload extracted and Docker image built successfully, but export failed",
+            "export_error": export_result
+        })
+        return result
+    
+    # The exported tar's size stands in for the image size in /status
+    with built_images_lock:
+        if build_result["image_name"] in built_images:
+            built_images[build_result["image_name"]]["size"] = export_result["original_size"]
+    
+    # Store chunk information for download
+    with image_chunks_lock:
+        image_chunks[upload_id] = {
+            "image_name": build_result["image_name"],
+            "architecture": architecture,
+            "chunk_files": export_result["chunk_files"],
+            "total_chunks": export_result["total_chunks"],
+            "chunk_size": export_result["chunk_size"],
+            "original_size": export_result["original_size"],
+            "created_at": time.time()
+        }
+    
+    logger.info("Extracted, built and exported Docker image for %s", filename)
+    result.update({
+        "status": "completed",
+        "message": "Upload extracted, Docker image built and exported successfully",
+        "image_chunks_available": export_result["total_chunks"],
+        "image_size": export_result["original_size"]
+    })
+    return result
+
+def split_architectures(architecture):
+    """Split a comma-separated architecture field into its distinct names, in order"""
+    return list(dict.fromkeys(arch.strip() for arch in architecture.split(",") if arch.strip()))
+
+def normalize_architecture(architecture):
+    """Return an upload's architecture field without blanks or repeats (raises ValueError on an unsupported name)"""
+    # Checked when the upload arrives rather than once the whole archive is in. A repeated
+    # name would run two builds sharing one image ID, tag, build log and chunk files
+    architectures = split_architectures(architecture)
+    if not architectures:
+        raise ValueError("No architecture given")
+    unsupported = [arch for arch in architectures if arch not in ARCHITECTURE_PLATFORMS]
+    if unsupported:
+        raise ValueError(f"Unsupported architecture {', '.join(unsupported)}, "
+                         f"expected {', '.join(arch for arch in ARCHITECTURE_PLATFORMS if arch != 'unknown')}")
+    return ",".join(architectures)
+
+def build_and_export_images(extract_dir, architecture, upload_id, filename):
+    """Build and export one image per comma-separated architecture of an upload, concurrently (runs on job_executor)"""
+    architectures = split_architectures(architecture) or ["unknown"]
+    if len(architectures) == 1:
+        return build_and_export_image(extract_dir, architectures[0], upload_id, filename)
+    
+    # Each architecture gets its own ID so their images, build logs and chunk
+    # files don't collide; clients download each one from /image/<its id>
+    image_ids = {arch: str(uuid.uuid4()) for arch in architectures}
+    
+    # All the builds read the same extracted context, release it after the last one
+    builds_remaining = [len(architectures)]
+    builds_remaining_lock = threading.Lock()
+    def release_after_last_build(workdir):
+        with builds_remaining_lock:
+            builds_remaining[0] -= 1
+            last_build = builds_remaining[0] == 0
+        if last_build:
+            release_workdir(workdir)
+    
+    # The builds and their docker save exports run side by side, rather than one
+    # architecture after another
+    with ThreadPoolExecutor(max_workers=len(architectures)) as arch_executor:
+        futures = {
+            arch: arch_executor.submit(build_and_export_image, extract_dir, arch, image_ids[arch], filename,
+                                       release_after_last_build)
+            for arch in architectures
+        }
+        images = {arch: future.result() for arch, future in futures.items()}
+    
+    failed = [arch for arch, image in images.items() if image["status"] != "completed"]
+    return {
+        "id": upload_id,
+        "architecture": architecture,
+        "filename": filename,
+        "extracted_to": extract_dir,
+        "status": "failed" if failed else "completed",
+        "message": (f"Docker build or export failed for {', '.join(failed)}" if failed
+                    else f"Upload extracted, Docker images built and exported successfully for {len(architectures)} architectures"),
+        "images": images
+    }
+
+class ChunkedUploadReader:
+    """Sequential file-like view of a chunked upload's staging file that blocks until each chunk has arrived"""
+    def __init__(self, tracker_entry):
+        self.tracker_entry = tracker_entry
+        self.position = 0
+        self.available = 0
+        self.next_chunk = 0
+    
+    def wait_for_chunk(self):
+        """Wait for the next chunk in index order and make it readable (False at the end or on abort)"""
+        tracker_entry = self.tracker_entry
+        chunk_index = self.next_chunk
+        total_chunks = tracker_entry['total_chunks']
+        if chunk_index == total_chunks:
+            return False
         
-        if missing_chunks:
-            return False, f"Missing chunks: {missing_chunks}"
+        bitmap = tracker_entry['bitmap']
+        with tracker_entry['chunk_ready']:
+            while not bitmap[chunk_index >> 3] & (1 << (chunk_index & 7)):
+                if tracker_entry['aborted']:
+                    return False
+                tracker_entry['chunk_ready'].wait()
+            length = tracker_entry['last_chunk_length'] if chunk_index == total_chunks - 1 else tracker_entry['chunk_size']
         
-        # Combine chunks
-        with open(combined_file_path, 'wb') as combined_file:
-            for i in range(total_chunks):
-                chunk_path = f"./temp_{upload_id}_chunk_{i}"
+        self.available += length
+        self.next_chunk += 1
+        return True
+    
+    def read(self, size=-1):
+        if self.position == self.available and not self.wait_for_chunk():
+            return b""
+        remaining = self.available - self.position
+        if size is None or size < 0 or size > remaining:
+            size = remaining
+        data = os.pread(self.tracker_entry['fd'], size, self.position)
+        self.position += len(data)
+        return data
+    
+    def sendfile_to(self, out_fd):
+        """Copy the rest of the upload to out_fd with sendfile, waiting for each chunk as read() does"""
+        while self.position < self.available or self.wait_for_chunk():
+            copied = sendfile_range(out_fd, self.tracker_entry['fd'], self.position, self.available - self.position)
+            if not copied:
+                break
+            self.position += copied
+
+def extract_chunked_upload(tracker_entry):
+    """Extract a chunked upload in order as its chunks arrive (runs on its own thread)"""
+    try:
+        tracker_entry['extract_error'] = extract_archive(
+            ChunkedUploadReader(tracker_entry), tracker_entry['extract_dir'], tracker_entry['original_filename']
+        )
+    except Exception as e:
+        tracker_entry['extract_error'] = str(e)
+
+def missing_chunks(tracker_entry, limit=100):
+    """List up to limit indices of chunks an upload has not received yet, lowest first"""
+    total_chunks = tracker_entry['total_chunks']
+    with tracker_entry['lock']:
+        received_mask = int.from_bytes(tracker_entry['bitmap'], 'little')
+    # Bit i of the mask is chunk i, so the clear bits below total_chunks are the gaps
+    missing_mask = ~received_mask & ((1 << total_chunks) - 1)
+    missing = []
+    while missing_mask and len(missing) < limit:
+        lowest = missing_mask & -missing_mask
+        missing.append(lowest.bit_length() - 1)
+        missing_mask ^= lowest
+    return missing
+    
+def close_staging_file(tracker_entry):
+    """Close and remove a chunked upload's staging file (once, however many times it is called)"""
+    with tracker_entry['lock']:
+        fd, tracker_entry['fd'] = tracker_entry['fd'], None
+    if fd is None:
+        return
+    os.close(fd)
+    try:
+        os.remove(tracker_entry['combined_file_path'])
+    except OSError:
+        pass
+    received_tars.discard(tracker_entry['combined_file_path'])
+
+def process_combined_upload(tracker_entry):
+    """Wait for a chunked upload to finish extracting, then build and export it (runs on job_executor)"""
+    upload_id = tracker_entry['upload_id']
+    architecture = tracker_entry['architecture']
+    filename = tracker_entry['original_filename']
+    extract_dir = tracker_entry['extract_dir']
+    
+    # Every chunk is in, so the extractor is working through the last of them
+    tracker_entry['extractor'].join()
+    close_staging_file(tracker_entry)
+    
+    if tracker_entry['extract_error'] is not None:
+        extract_result = f"Extraction failed: {tracker_entry['extract_error']}"
+        release_workdir(extract_dir)
+        logger.warning("Combined upload %s but extraction failed: %s", filename, extract_result)
+        return {
+            "status": "failed",
+            "message": "All chunks received and combined successfully, but extraction failed",
+            "id": upload_id,
+            "architecture": architecture,
+            "filename": filename,
+            "extraction_error": extract_result
+        }
+    
+    logger.info("Extracted %s to %s", filename, extract_dir)
+    return build_and_export_images(extract_dir, architecture, upload_id, filename)
+
+def abort_chunked_upload(tracker_entry):
+    """Stop an unfinished chunked upload's extraction and release its files"""
+    with tracker_entry['chunk_ready']:
+        tracker_entry['aborted'] = True
+        tracker_entry['chunk_ready'].notify_all()
+        # Chunks already being written finish before their staging file is closed;
+        # no new ones start once the upload is aborted
+        while tracker_entry['writing']:
+            tracker_entry['chunk_ready'].wait()
+    # The extractor sees the end of its input and gives up on the truncated archive
+    tracker_entry['extractor'].join()
+    close_staging_file(tracker_entry)
+    release_workdir(tracker_entry['extract_dir'])
+
+def copy_spooled_chunk_at(fd, stream, offset, max_length):
+    """Copy a multipart part spooled to disk into the staging file in-kernel (returns bytes copied, or None if unsupported)"""
+    src_fd = stream.fileno()
+    src_offset = stream.tell()
+    length = os.fstat(src_fd).st_size - src_offset
+    if length > max_length:
+        raise ValueError(f"Chunk is larger than {max_length} bytes")
+    copied = 0
+    while copied < length:
+        try:
+            count = os.copy_file_range(src_fd, fd, length - copied, src_offset + copied, offset + copied)
+        except OSError as e:
+            if copied or e.errno not in (errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP):
+                raise
+            return None
+        if count == 0:
+            break
+        copied += count
+    return copied
+
+# Per-thread buffer that chunk bodies are read into, reused across requests rather
+# than allocating a new bytes object for every block of every chunk
+chunk_buffers = threading.local()
+
+def get_chunk_buffer():
+    """Return this thread's reusable STREAM_BUFFER_SIZE read buffer"""
+    buffer = getattr(chunk_buffers, "buffer", None)
+    if buffer is None:
+        buffer = chunk_buffers.buffer = memoryview(bytearray(STREAM_BUFFER_SIZE))
+    return buffer
+
+def write_chunk_at(fd, stream, offset, max_length, hasher=None):
+    """Stream a chunk of at most max_length bytes into the staging file starting at the given offset"""
+    # A multipart part that outgrew its spool is already a file on disk
+    if hasher is None and hasattr(os, "copy_file_range") and getattr(stream, "_rolled", False):
+        copied = copy_spooled_chunk_at(fd, stream, offset, max_length)
+        if copied is not None:
+            return copied
+    
+    buffer = get_chunk_buffer()
+    # Werkzeug hands through gunicorn's request body as-is (gunicorn sets
+    # wsgi.input_terminated), and that has read() but no readinto()
+    readinto = getattr(stream, "readinto", None)
+    written = 0
+    while True:
+        # Ask for one byte past max_length so an oversized chunk is caught before it
+        # overwrites the start of the next one
+        size = min(STREAM_BUFFER_SIZE, max_length - written + 1)
+        if readinto is not None:
+            length = readinto(buffer[:size])
+            view = buffer[:length]
+        else:
+            view = memoryview(stream.read(size))
+            length = len(view)
+        if not length:
+            break
+        if written + length > max_length:
+            raise ValueError(f"Chunk is larger than {max_length} bytes")
+        if hasher is not None:
+            hasher.update(view)
+        while view:
+            count = os.pwrite(fd, view, offset + written)
+            view = view[count:]
+            written += count
+    return written
+
+def drain_stream(stream):
+    """Read and discard the rest of a request body"""
+    readinto = getattr(stream, "readinto", None)
+    if readinto is not None:
+        buffer = get_chunk_buffer()
+        while readinto(buffer):
+            pass
+    else:
+        while stream.read(STREAM_BUFFER_SIZE):
+            pass
+
+# Upload metadata field names, in UploadMeta field order, for multipart form fields and raw-body headers
+UPLOAD_FORM_FIELDS = ("architecture", "chunk_index", "total_chunks", "chunk_size", "total_size", "original_filename",
+                      "chunk_sha256")
+UPLOAD_HEADER_FIELDS = ("X-Architecture", "X-Chunk-Index", "X-Total-Chunks", "X-Chunk-Size", "X-Total-Size", "X-Original-Filename",
+                        "X-Chunk-Sha256")
+
+@dataclass(slots=True)
+class UploadMeta:
+    """Upload metadata sent alongside a file or chunk, with the integer fields already converted"""
+    architecture: str = "unknown"
+    chunk_index: int | None = None
+    total_chunks: int | None = None
+    chunk_size: int | None = None
+    total_size: int | None = None
+    original_filename: str | None = None
+    chunk_sha256: str | None = None
+    
+    @classmethod
+    def parse(cls, fields, names):
+        """Read metadata from a form or header mapping (raises ValueError on a malformed integer)"""
+        architecture, chunk_index, total_chunks, chunk_size, total_size, original_filename, chunk_sha256 = map(fields.get, names)
+        return cls(
+            architecture or "unknown",
+            None if chunk_index is None else int(chunk_index),
+            None if total_chunks is None else int(total_chunks),
+            None if chunk_size is None else int(chunk_size),
+            None if total_size is None else int(total_size),
+            original_filename,
+            None if chunk_sha256 is None else chunk_sha256.lower()
+        )
+    
+    @property
+    def is_chunk(self):
+        return self.chunk_index is not None and self.total_chunks is not None
+
+def is_completed_chunk(completed, meta):
+    """True if a chunk is one already received by a recently completed upload"""
+    return (time.time() - completed['completed_at'] <= COMPLETED_UPLOAD_GRACE
+            and completed['total_chunks'] == meta.total_chunks and completed['chunk_size'] == meta.chunk_size
+            and meta.chunk_sha256 is not None
+            and completed['chunk_digests'].get(meta.chunk_index) == meta.chunk_sha256)
+
+def queued_upload_response(upload_id, architecture, filename):
+    """The 202 reply to the chunk that completed an upload and queued its build"""
+    return jsonify({
+        "message": "All chunks received and combined successfully, build queued",
+        "id": upload_id,
+        "job_id": upload_id,
+        "architecture": architecture,
+        "filename": filename
+    }), 202
+
+def receive_chunk(stream, meta):
+    """Write one chunk of a chunked upload and process the upload once all chunks are in"""
+    architecture = meta.architecture
+    chunk_index, total_chunks, chunk_size, total_size = meta.chunk_index, meta.total_chunks, meta.chunk_size, meta.total_size
+    original_filename = meta.original_filename
+    
+    # Validate chunk parameters
+    if chunk_size is None or chunk_index < 0 or total_chunks <= 0 or chunk_index >= total_chunks or chunk_size <= 0:
+        return jsonify({"error": "Invalid chunk parameters"}), 400
+    if total_size is not None and (total_size <= 0 or -(-total_size // chunk_size) != total_chunks):
+        return jsonify({"error": "Invalid total_size"}), 400
+    
+    logger.debug("Receiving chunk %d/%d for %s", chunk_index + 1, total_chunks, original_filename)
+    
+    # Create a unique identifier for this chunked upload
+    upload_key = f"{original_filename}_{architecture}"
+    
+    with chunk_tracker_lock:
+        completed = None if upload_key in chunk_tracker else completed_uploads.get(upload_key)
+    if completed is not None and is_completed_chunk(completed, meta):
+        drain_stream(stream)
+        logger.info("Chunk %d of completed upload %s retried, answering with its job", chunk_index, completed['upload_id'])
+        return queued_upload_response(completed['upload_id'], architecture, original_filename)
+    
+    # Get or create the tracker entry under the tracker lock so two first chunks
+    # of the same upload can't both create (and truncate) the staging file
+    with chunk_tracker_lock:
+        if upload_key not in chunk_tracker:
+            # The filename is part of the upload key, so it only needs checking once
+            if not original_filename.endswith(ARCHIVE_EXTENSIONS):
+                return jsonify({"error": "Invalid original file type, only .tar.gz, .tar.zst or .tar allowed"}), 400
+            
+            # Only the first chunk of an upload needs a new ID
+            upload_id = str(uuid.uuid4())
+            
+            # Chunks are written into the staging file at their offset, and extracted
+            # from there in order while the rest of the upload arrives. The file is
+            # named per upload: a chunk retried after its upload completed starts a
+            # new entry, and must not truncate a file that is still being extracted.
+            # The client's filename is sanitized so it can't point outside this directory
+            combined_file_path = f"./received_{upload_id[:8]}_{secure_filename(original_filename)}"
+            try:
+                fd = os.open(combined_file_path, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o644)
+            except OSError as e:
+                return jsonify({"error": f"Failed to create combined file: {str(e)}"}), 500
+            received_tars.add(combined_file_path)
+            
+            # Reserve the whole file up front so it is laid out in few extents
+            if total_size is not None:
                 try:
-                    with open(chunk_path, 'rb') as chunk_file:
-                        combined_file.write(chunk_file.read())
-                    os.remove(chunk_path)  # Clean up chunk file
-                    print(f"Combined and removed chunk {i}")
-                except Exception as e:
-                    return False, f"Error processing chunk {i}: {str(e)}"
+                    os.posix_fallocate(fd, 0, total_size)
+                except OSError as e:
+                    # Not every filesystem supports fallocate, still size the file up front
+                    logger.warning("Could not preallocate %s: %s", combined_file_path, e)
+                    os.ftruncate(fd, total_size)
+            
+            lock = threading.Lock()
+            chunk_tracker[upload_key] = {
+                'bitmap': bytearray((total_chunks + 7) // 8),
+                'received_count': 0,
+                'total_chunks': total_chunks,
+                'chunk_size': chunk_size,
+                'total_size': total_size,
+                'last_chunk_length': None,
+                'original_filename': original_filename,
+                'architecture': architecture,
+                'upload_id': upload_id,
+                'combined_file_path': combined_file_path,
+                'fd': fd,
+                'extract_dir': acquire_workdir(upload_id),
+                'extract_error': None,
+                'aborted': False,
+                'writing': set(),
+                'chunk_digests': {},
+                'lock': lock,
+                'chunk_ready': threading.Condition(lock),
+                'last_activity': time.time()
+            }
+            extractor = threading.Thread(target=extract_chunked_upload, args=(chunk_tracker[upload_key],), daemon=True)
+            chunk_tracker[upload_key]['extractor'] = extractor
+            extractor.start()
+        else:
+            upload_id = chunk_tracker[upload_key]['upload_id']
+            # Validate consistency
+            if chunk_tracker[upload_key]['total_chunks'] != total_chunks:
+                return jsonify({"error": "Inconsistent total_chunks for this upload"}), 400
+            if chunk_tracker[upload_key]['chunk_size'] != chunk_size:
+                return jsonify({"error": "Inconsistent chunk_size for this upload"}), 400
+            if total_size is not None and chunk_tracker[upload_key]['total_size'] != total_size:
+                return jsonify({"error": "Inconsistent total_size for this upload"}), 400
         
-        print(f"✓ Successfully created combined file: {combined_file_path}")
-        return True, "File combined successfully"
+        tracker_entry = chunk_tracker[upload_key]
+        tracker_entry['last_activity'] = time.time()
+    
+    # Write the chunk at its final offset in the staging file. Every chunk but the
+    # last is exactly chunk_size bytes; the last one is known only from total_size
+    offset = chunk_index * chunk_size
+    if total_size is not None:
+        expected_length = min(chunk_size, total_size - offset)
+    elif chunk_index < total_chunks - 1:
+        expected_length = chunk_size
+    else:
+        expected_length = None
     
+    # A chunk is written by one request at a time, and never again once it has been
+    # accepted: the extractor may already be reading it, so a retry of an accepted
+    # chunk (corrupted or not) must not overwrite its bytes
+    bitmap = tracker_entry['bitmap']
+    mask = 1 << (chunk_index & 7)
+    with tracker_entry['chunk_ready']:
+        if tracker_entry['aborted']:
+            # Evicted or cleaned up since this request found it; its staging file is closed
+            return jsonify({"error": "Upload was aborted"}), 410
+        already_received = bitmap[chunk_index >> 3] & mask
+        if not already_received:
+            if chunk_index in tracker_entry['writing']:
+                return jsonify({"error": f"Chunk {chunk_index} is already being received"}), 409
+            tracker_entry['writing'].add(chunk_index)
+        received_count = tracker_entry['received_count']
+    if already_received:
+        drain_stream(stream)
+        return jsonify({
+            "message": f"Chunk {chunk_index + 1}/{total_chunks} already received",
+            "chunks_received": received_count,
+            "chunks_total": total_chunks
+        }), 200
+    
+    # A chunk sent with its SHA-256 is hashed as it is written rather than re-read afterwards
+    hasher = hashlib.sha256() if meta.chunk_sha256 else None
+    error = None
+    try:
+        written = write_chunk_at(tracker_entry['fd'], stream, offset, expected_length or chunk_size, hasher)
+    except ValueError as e:
+        error = jsonify({"error": str(e)}), 400
     except Exception as e:
-        return False, f"Error combining chunks: {str(e)}"
+        error = jsonify({"error": f"Failed to save chunk: {str(e)}"}), 500
+    else:
+        if expected_length is not None and written != expected_length:
+            error = jsonify({"error": f"Incomplete chunk: received {written} of {expected_length} bytes"}), 400
+        elif hasher is not None and hasher.hexdigest() != meta.chunk_sha256:
+            # Leave the chunk unmarked so the extractor never reads it; a retry overwrites it
+            error = jsonify({"error": f"Chunk {chunk_index} failed its SHA-256 check"}), 400
+    
+    # Mark this chunk as received and wake the extractor, or an abort waiting for
+    # this write to finish
+    with tracker_entry['chunk_ready']:
+        tracker_entry['writing'].discard(chunk_index)
+        tracker_entry['last_activity'] = time.time()
+        if error is None and tracker_entry['aborted']:
+            error = jsonify({"error": "Upload was aborted"}), 410
+        if error is None:
+            if chunk_index == total_chunks - 1:
+                tracker_entry['last_chunk_length'] = written
+            bitmap[chunk_index >> 3] |= mask
+            tracker_entry['received_count'] += 1
+            if meta.chunk_sha256 is not None:
+                tracker_entry['chunk_digests'][chunk_index] = meta.chunk_sha256
+        tracker_entry['chunk_ready'].notify_all()
+        received_count = tracker_entry['received_count']
+        all_received = received_count == total_chunks
+    if error is not None:
+        return error
+    
+    logger.debug("Wrote chunk %d at offset %d of %s (%d/%d received)",
+                 chunk_index, offset, tracker_entry['combined_file_path'], received_count, total_chunks)
+    
+    # Check if all chunks are received
+    if all_received:
+        # Take the upload out of tracking, unless /cleanup or eviction has taken (and
+        # is aborting) it since this chunk was marked; the key may even belong to a
+        # newer upload by now
+        with chunk_tracker_lock, tracker_entry['chunk_ready']:
+            owned = chunk_tracker.get(upload_key) is tracker_entry and not tracker_entry['aborted']
+            if owned:
+                del chunk_tracker[upload_key]
+                completed_uploads[upload_key] = {
+                    'upload_id': upload_id,
+                    'total_chunks': total_chunks,
+                    'chunk_size': chunk_size,
+                    'chunk_digests': tracker_entry['chunk_digests'],
+                    'completed_at': time.time()
+                }
+        if not owned:
+            return jsonify({"error": "Upload was aborted"}), 410
+        
+        # Finish extracting, then build and export in the background
+        jobs[upload_id] = job_executor.submit(process_combined_upload, tracker_entry)
+            
+        logger.info("All chunks received for %s, queued job %s", original_filename, upload_id)
+        return queued_upload_response(upload_id, architecture, original_filename)
+    else:
+        return jsonify({
+            "message": f"Chunk {chunk_index + 1}/{total_chunks} received successfully",
+            "chunks_received": received_count,
+            "chunks_total": total_chunks
+        }), 200
+
+def receive_single_file(stream, architecture, filename):
+    """Extract a single (non-chunked) upload as it is received and queue its build"""
+    upload_id = str(uuid.uuid4())
+    
+    if not filename.endswith(ARCHIVE_EXTENSIONS):
+        return jsonify({"error": "Invalid file type, only .tar.gz, .tar.zst or .tar allowed"}), 400
+    
+    logger.info("Receiving single file: %s", filename)
+    
+    try:
+        # Extract the upload as it streams in instead of saving it first
+        extract_dir = acquire_workdir(upload_id)
+        extract_success, extract_result = extract_tar_stream(stream, extract_dir, filename)
+        
+        if extract_success:
+            # Build and export in the background
+            jobs[upload_id] = job_executor.submit(
+                build_and_export_images, extract_result, architecture, upload_id, filename
+            )
+            
+            logger.info("Received and extracted %s, queued job %s", filename, upload_id)
+            return jsonify({
+                "message": "File received and extracted successfully, build queued",
+                "id": upload_id,
+                "job_id": upload_id,
+                "architecture": architecture,
+                "filename": filename,
+                "extracted_to": extract_result
+            }), 202
+        else:
+            release_workdir(extract_dir)
+            logger.warning("Received %s but extraction failed: %s", filename, extract_result)
+            return jsonify({
+                "message": "File received successfully, but extraction failed",
+                "id": upload_id,
+                "architecture": architecture,
+                "filename": filename,
+                "extraction_error": extract_result
+            }), 200
+    
+    except Exception as e:
+        return jsonify({"error": f"Failed to save file: {str(e)}"}), 500
+
 
 @app.route("/")
 def index():
@@ -193,9 +1154,18 @@ def health_check():
     }), 200
 
 
+@app.route("/config", methods=["GET"])
+def get_upload_config():
+    """Get the chunk size and number of concurrent chunk uploads senders should use"""
+    return jsonify({
+        "max_concurrent_chunks": MAX_CONCURRENT_CHUNKS,
+        "chunk_size": SUGGESTED_CHUNK_SIZE
+    }), 200
+
+
 @app.route("/data", methods=["POST"])
 def receive_data():
-    """Receive .tar.gz file or chunks"""
+    """Receive .tar.gz/.tar.zst/.tar file or chunks"""
     try:
         # Validate file in request
         if 'file' not in request.files:
@@ -206,261 +1176,218 @@ def receive_data():
             return jsonify({"error": "No selected file"}), 400
         
         # Get additional data from the request
-        architecture = request.form.get('architecture', 'unknown')
-        chunk_index = request.form.get('chunk_index')
-        total_chunks = request.form.get('total_chunks')
-        original_filename = request.form.get('original_filename')
+        try:
+            meta = UploadMeta.parse(request.form, UPLOAD_FORM_FIELDS)
+        except ValueError:
+            return jsonify({"error": "Invalid chunk_index, total_chunks, chunk_size or total_size format"}), 400
+        try:
+            meta.architecture = normalize_architecture(meta.architecture)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
         
-        upload_id = str(uuid.uuid4())
+        # Handle chunked upload
+        if meta.is_chunk and meta.original_filename is not None:
+            return receive_chunk(file.stream, meta)
+        
+        # Handle single file upload (non-chunked)
+        else:
+            return receive_single_file(file.stream, meta.architecture, file.filename)
+    
+    except Exception as e:
+        logger.exception("Error in receive_data")
+        return jsonify({"error": f"Server error: {str(e)}"}), 500
+
+
+@app.route("/data_raw", methods=["POST"])
+def receive_data_raw():
+    """Receive a raw archive body or chunk, with metadata sent in X- headers or the query string"""
+    try:
+        # Metadata travels outside the body so it can be streamed without multipart
+        # parsing. A header wins over a query parameter of the same field
+        fields = {header: request.headers.get(header, request.args.get(name))
+                  for header, name in zip(UPLOAD_HEADER_FIELDS, UPLOAD_FORM_FIELDS)}
+        try:
+            meta = UploadMeta.parse(fields, UPLOAD_HEADER_FIELDS)
+        except ValueError:
+            return jsonify({"error": "Invalid chunk_index, total_chunks, chunk_size or total_size format"}), 400
+        try:
+            meta.architecture = normalize_architecture(meta.architecture)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        
+        if not meta.original_filename:
+            return jsonify({"error": "Missing X-Original-Filename header or original_filename parameter"}), 400
         
         # Handle chunked upload
-        if chunk_index is not None and total_chunks is not None and original_filename is not None:
-            try:
-                chunk_index = int(chunk_index)
-                total_chunks = int(total_chunks)
-            except ValueError:
-                return jsonify({"error": "Invalid chunk_index or total_chunks format"}), 400
-            
-            # Validate chunk parameters
-            if chunk_index < 0 or total_chunks <= 0 or chunk_index >= total_chunks:
-                return jsonify({"error": "Invalid chunk parameters"}), 400
-            
-            if not original_filename.endswith(".tar.gz"):
-                return jsonify({"error": "Invalid original file type, only .tar.gz allowed"}), 400
-            
-            print(f"Receiving chunk {chunk_index + 1}/{total_chunks} for {original_filename}")
-            
-            # Create a unique identifier for this chunked upload
-            upload_key = f"{original_filename}_{architecture}"
-            
-            # Initialize tracking for this upload if not exists
-            if upload_key not in chunk_tracker:
-                chunk_tracker[upload_key] = {
-                    'received_chunks': set(),
-                    'total_chunks': total_chunks,
-                    'original_filename': original_filename,
-                    'architecture': architecture,
-                    'upload_id': upload_id
-                }
-            else:
-                upload_id = chunk_tracker[upload_key]['upload_id']
-                # Validate consistency
-                if chunk_tracker[upload_key]['total_chunks'] != total_chunks:
-                    return jsonify({"error": "Inconsistent total_chunks for this upload"}), 400
-            
-            # Save the chunk
-            chunk_path = f"./temp_{upload_id}_chunk_{chunk_index}"
-            try:
-                file.save(chunk_path)
-            except Exception as e:
-                return jsonify({"error": f"Failed to save chunk: {str(e)}"}), 500
-            
-            # Mark this chunk as received
-            chunk_tracker[upload_key]['received_chunks'].add(chunk_index)
-            
-            print(f"Saved chunk {chunk_index} to {chunk_path}")
-            print(f"Received {len(chunk_tracker[upload_key]['received_chunks'])}/{total_chunks} chunks")
-            
-            # Check if all chunks are received
-            if len(chunk_tracker[upload_key]['received_chunks']) == total_chunks:
-                print("All chunks received, combining...")
-                success, message = combine_chunks(original_filename, total_chunks, upload_id)
-                
-                if success:
-                    # Extract the combined tar file
-                    tar_file_path = f"./received_{original_filename}"
-                    extract_success, extract_result = extract_tar_file(tar_file_path, upload_id)
-                    
-                    # Clean up tracking
-                    del chunk_tracker[upload_key]
-                    
-                    if extract_success:
-                        # Build Docker image for the specified architecture
-                        build_success, build_result = build_docker_image(extract_result, architecture, upload_id)
-                        
-                        if build_success:
-                            # Export and split the Docker image
-                            export_success, export_result = export_and_split_docker_image(
-                                build_result["image_name"], upload_id
-                            )
-                            
-                            if export_success:
-                                # Store chunk information for download
-                                image_chunks[upload_id] = {
-                                    "image_name": build_result["image_name"],
-                                    "architecture": architecture,
-                                    "chunk_files": export_result["chunk_files"],
-                                    "total_chunks": export_result["total_chunks"],
-                                    "original_size": export_result["original_size"],
-                                    "created_at": time.time()
-                                }
-                                
-                                print(f"✓ Successfully combined, extracted, built, and exported Docker image for {original_filename}")
-                                return jsonify({
-                                    "message": f"All chunks received, combined, extracted, Docker image built and exported successfully",
-                                    "id": upload_id,
-                                    "architecture": architecture,
-                                    "filename": original_filename,
-                                    "extracted_to": extract_result,
-                                    "docker_image": build_result["image_name"],
-                                    "platform": build_result["platform"],
-                                    "image_chunks_available": export_result["total_chunks"],
-                                    "image_size": export_result["original_size"]
-                                }), 200
-                            else:
-                                print(f"✓ Successfully built Docker image but export failed: {export_result}")
-                                return jsonify({
-                                    "message": f"All chunks received, combined, extracted, and Docker image built successfully, but export failed",
-                                    "id": upload_id,
-                                    "architecture": architecture,
-                                    "filename": original_filename,
-                                    "extracted_to": extract_result,
-                                    "docker_image": build_result["image_name"],
-                                    "platform": build_result["platform"],
-                                    "export_error": export_result
-                                }), 200
-                        else:
-                            print(f"✓ Successfully combined and extracted, but Docker build failed: {build_result}")
-                            return jsonify({
-                                "message": f"All chunks received, combined, and extracted successfully, but Docker build failed",
-                                "id": upload_id,
-                                "architecture": architecture,
-                                "filename": original_filename,
-                                "extracted_to": extract_result,
-                                "docker_build_error": build_result
-                            }), 200
-                    else:
-                        print(f"✗ Combined successfully but extraction failed: {extract_result}")
-                        return jsonify({
-                            "message": f"All chunks received and combined successfully, but extraction failed",
-                            "id": upload_id,
-                            "architecture": architecture,
-                            "filename": original_filename,
-                            "extraction_error": extract_result
-                        }), 200
-                else:
-                    return jsonify({"error": f"Failed to combine chunks: {message}"}), 500
-            else:
-                return jsonify({
-                    "message": f"Chunk {chunk_index + 1}/{total_chunks} received successfully",
-                    "chunks_received": len(chunk_tracker[upload_key]['received_chunks']),
-                    "chunks_total": total_chunks
-                }), 200
+        if meta.is_chunk:
+            return receive_chunk(request.stream, meta)
         
         # Handle single file upload (non-chunked)
         else:
-            if not file.filename.endswith(".tar.gz"):
-                return jsonify({"error": "Invalid file type, only .tar.gz allowed"}), 400
-            
-            print(f"Receiving single file: {file.filename}")
-            
-            tar_file_path = f"./received_{file.filename}"
-            try:
-                file.save(tar_file_path)
-                print(f"✓ Successfully saved {file.filename}")
-                
-                # Extract the tar file
-                extract_success, extract_result = extract_tar_file(tar_file_path, upload_id)
-                
-                if extract_success:
-                    # Build Docker image for the specified architecture
-                    build_success, build_result = build_docker_image(extract_result, architecture, upload_id)
-                    
-                    if build_success:
-                        # Export and split the Docker image
-                        export_success, export_result = export_and_split_docker_image(
-                            build_result["image_name"], upload_id
-                        )
-                        
-                        if export_success:
-                            # Store chunk information for download
-                            image_chunks[upload_id] = {
-                                "image_name": build_result["image_name"],
-                                "architecture": architecture,
-                                "chunk_files": export_result["chunk_files"],
-                                "total_chunks": export_result["total_chunks"],
-                                "original_size": export_result["original_size"],
-                                "created_at": time.time()
-                            }
-                            
-                            print(f"✓ Successfully received, extracted, built, and exported Docker image for {file.filename}")
-                            return jsonify({
-                                "message": "File received, extracted, Docker image built and exported successfully", 
-                                "id": upload_id,
-                                "architecture": architecture,
-                                "filename": file.filename,
-                                "extracted_to": extract_result,
-                                "docker_image": build_result["image_name"],
-                                "platform": build_result["platform"],
-                                "image_chunks_available": export_result["total_chunks"],
-                                "image_size": export_result["original_size"]
-                            }), 200
-                        else:
-                            print(f"✓ Successfully built Docker image but export failed: {export_result}")
-                            return jsonify({
-                                "message": "File received, extracted, and Docker image built successfully, but export failed",
-                                "id": upload_id,
-                                "architecture": architecture,
-                                "filename": file.filename,
-                                "extracted_to": extract_result,
-                                "docker_image": build_result["image_name"],
-                                "platform": build_result["platform"],
-                                "export_error": export_result
-                            }), 200
-                    else:
-                        print(f"✓ Successfully received and extracted, but Docker build failed: {build_result}")
-                        return jsonify({
-                            "message": "File received and extracted successfully, but Docker build failed",
-                            "id": upload_id,
-                            "architecture": architecture,
-                            "filename": file.filename,
-                            "extracted_to": extract_result,
-                            "docker_build_error": build_result
-                        }), 200
-                else:
-                    print(f"✗ Received successfully but extraction failed: {extract_result}")
-                    return jsonify({
-                        "message": "File received successfully, but extraction failed",
-                        "id": upload_id,
-                        "architecture": architecture,
-                        "filename": file.filename,
-                        "extraction_error": extract_result
-                    }), 200
-                    
-            except Exception as e:
-                return jsonify({"error": f"Failed to save file: {str(e)}"}), 500
+            return receive_single_file(request.stream, meta.architecture, meta.original_filename)
     
     except Exception as e:
-        print(f"✗ Error in receive_data: {str(e)}")
+        logger.exception("Error in receive_data_raw")
         return jsonify({"error": f"Server error: {str(e)}"}), 500
 
 
+@app.route("/jobs/<job_id>", methods=["GET"])
+def get_job_status(job_id):
+    """Get the status of a background extract/build/export job"""
+    if job_id not in jobs:
+        return jsonify({"error": "Job not found"}), 404
+    
+    future = jobs[job_id]
+    if not future.done():
+        return jsonify({
+            "job_id": job_id,
+            "status": "running" if future.running() else "queued"
+        }), 200
+    
+    try:
+        result = future.result()
+    except Exception as e:
+        return jsonify({
+            "job_id": job_id,
+            "status": "failed",
+            "error": f"Job failed: {str(e)}"
+        }), 200
+    
+    return jsonify({"job_id": job_id, **result}), 200
+
+
 @app.route("/image/<upload_id>/info", methods=["GET"])
 def get_image_info(upload_id):
     """Get information about available image chunks for download"""
-    if upload_id not in image_chunks:
+    chunk_info = image_chunks.get(upload_id)
+    if chunk_info is None:
         return jsonify({"error": "Image chunks not found for this upload ID"}), 404
-    
-    chunk_info = image_chunks[upload_id]
     return jsonify({
         "upload_id": upload_id,
         "image_name": chunk_info["image_name"],
         "architecture": chunk_info["architecture"],
         "total_chunks": chunk_info["total_chunks"],
+        "chunk_size": chunk_info["chunk_size"],
         "original_size": chunk_info["original_size"],
         "created_at": chunk_info["created_at"],
         "chunk_files": chunk_info["chunk_files"]
     }), 200
 
 
+def read_image_range(chunk_files, chunk_size, start, stop):
+    """Yield bytes start to stop of an exported image from its chunk files"""
+    position = start
+    while position < stop:
+        chunk_index, chunk_offset = divmod(position, chunk_size)
+        with open(f"./{chunk_files[chunk_index]}", 'rb') as chunk_file:
+            chunk_file.seek(chunk_offset)
+            remaining = min(stop, (chunk_index + 1) * chunk_size) - position
+            while remaining:
+                data = chunk_file.read(min(STREAM_BUFFER_SIZE, remaining))
+                if not data:
+                    return
+                yield data
+                remaining -= len(data)
+                position += len(data)
+
+
+@app.route("/image/<upload_id>", methods=["GET"])
+def download_image(upload_id):
+    """Download the whole Docker image, or the byte range asked for in a Range header"""
+    chunk_info = image_chunks.get(upload_id)
+    if chunk_info is None:
+        return jsonify({"error": "Image chunks not found for this upload ID"}), 404
+    image_size = chunk_info["original_size"]
+    
+    # Ranges are served straight from the chunk files, so a client can fetch or
+    # resume the image at any offset without the server reassembling it
+    start, stop, status = 0, image_size, 200
+    # Only a single byte range is served partially; a multi-range request (or another
+    # unit) ignores the Range header and gets the whole image, as RFC 9110 allows
+    if request.range is not None and request.range.units == "bytes" and len(request.range.ranges) == 1:
+        bounds = request.range.range_for_length(image_size)
+        if bounds is None:
+            return jsonify({"error": "Requested range not satisfiable"}), 416, {"Content-Range": f"bytes */{image_size}"}
+        start, stop = bounds
+        status = 206
+    
+    response = Response(read_image_range(chunk_info["chunk_files"], chunk_info["chunk_size"], start, stop),
+                        status=status, mimetype="application/x-tar")
+    response.headers["Content-Length"] = str(stop - start)
+    response.headers["Accept-Ranges"] = "bytes"
+    response.headers["Content-Disposition"] = f"attachment; filename=docker_image_{upload_id[:8]}.tar"
+    if status == 206:
+        response.headers["Content-Range"] = f"bytes {start}-{stop - 1}/{image_size}"
+    return response
+
+
+@app.route("/image/<upload_id>/stream", methods=["GET"])
+def stream_image(upload_id):
+    """Stream the Docker image straight from docker save, without its chunk files"""
+    chunk_info = image_chunks.get(upload_id)
+    if chunk_info is not None:
+        image_name = chunk_info["image_name"]
+    else:
+        # The image outlives its chunk files, which are removed by /image/<id>/complete
+        image_name = next((f"{image['name']}:{image['tag']}" for image in get_built_docker_images()
+                           if image["upload_id"] == upload_id), None)
+        if image_name is None:
+            return jsonify({"error": "Docker image not found for this upload ID"}), 404
+    
+    stderr_file = tempfile.TemporaryFile()
+    try:
+        process = subprocess.Popen(["docker", "save", image_name], stdout=subprocess.PIPE, stderr=stderr_file)
+    except OSError as e:
+        stderr_file.close()
+        logger.warning("Could not run docker save for %s: %s", image_name, e)
+        return jsonify({"error": f"Failed to export Docker image: {str(e)}"}), 500
+    
+    def read_stderr():
+        stderr_file.seek(0)
+        return stderr_file.read().decode(errors="replace")
+    
+    # docker save writes nothing until it has found the image, so waiting for the
+    # first block tells a missing image apart from an export before the 200 is sent
+    first_block = process.stdout.read(STREAM_BUFFER_SIZE)
+    if not first_block:
+        process.stdout.close()
+        returncode = process.wait()
+        error = read_stderr() or f"docker save exited with status {returncode}"
+        stderr_file.close()
+        logger.warning("Failed to stream Docker image %s: %s", image_name, error)
+        return jsonify({"error": f"Failed to export Docker image: {error}"}), 500
+    
+    def generate():
+        stopped = False
+        try:
+            data = first_block
+            while data:
+                yield data
+                data = process.stdout.read(STREAM_BUFFER_SIZE)
+        finally:
+            # Reached on a client disconnect too; stop docker save rather than leave it blocked
+            process.stdout.close()
+            if process.poll() is None:
+                process.kill()
+                stopped = True
+            returncode = process.wait()
+            if returncode != 0 and not stopped:
+                # Too late to change the status, the client only sees a truncated tar
+                logger.warning("docker save of %s failed part way: %s", image_name,
+                               read_stderr() or f"exited with status {returncode}")
+            stderr_file.close()
+    
+    return Response(generate(), mimetype="application/x-tar",
+                    headers={"Content-Disposition": f"attachment; filename=docker_image_{upload_id[:8]}.tar"})
+
+
 @app.route("/image/<upload_id>/chunk/<int:chunk_index>", methods=["GET"])
 def download_image_chunk(upload_id, chunk_index):
     """Download a specific chunk of the Docker image"""
-    if upload_id not in image_chunks:
+    chunk_info = image_chunks.get(upload_id)
+    if chunk_info is None:
         return jsonify({"error": "Image chunks not found for this upload ID"}), 404
     
-    chunk_info = image_chunks[upload_id]
-    
     if chunk_index < 0 or chunk_index >= chunk_info["total_chunks"]:
         return jsonify({"error": f"Invalid chunk index. Valid range: 0-{chunk_info['total_chunks']-1}"}), 400
     
@@ -471,34 +1398,104 @@ def download_image_chunk(upload_id, chunk_index):
         return jsonify({"error": f"Chunk file {chunk_filename} not found"}), 404
     
     try:
-        print(f"Sending chunk {chunk_index + 1}/{chunk_info['total_chunks']}: {chunk_filename}")
+        logger.debug("Sending chunk %d/%d: %s", chunk_index + 1, chunk_info['total_chunks'], chunk_filename)
         return send_file(chunk_path, as_attachment=True, download_name=chunk_filename)
     except Exception as e:
         return jsonify({"error": f"Failed to send chunk: {str(e)}"}), 500
 
 
+def remove_image_chunk_files(chunk_info):
+    """Delete an exported image's chunk files, returning how many were removed"""
+    cleanup_count = 0
+    for chunk_filename in chunk_info["chunk_files"]:
+        try:
+            os.remove(f"./{chunk_filename}")
+            cleanup_count += 1
+            logger.debug("Cleaned up image chunk: %s", chunk_filename)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning("Failed to remove chunk %s: %s", chunk_filename, e)
+    return cleanup_count
+
+def evict_stale_uploads():
+    """Abort chunked uploads that have gone idle and drop exported images that were never collected"""
+    now = time.time()
+    stale_uploads = []
+    with chunk_tracker_lock:
+        for key in [key for key, completed in completed_uploads.items()
+                    if now - completed['completed_at'] > COMPLETED_UPLOAD_GRACE]:
+            del completed_uploads[key]
+        for key, info in list(chunk_tracker.items()):
+            # Judged under the entry's own lock too, so an upload with a chunk still being
+            # written is kept, and no chunk can start writing once it has been judged idle
+            with info['chunk_ready']:
+                if info['writing'] or now - info['last_activity'] <= MAX_UPLOAD_IDLE:
+                    continue
+                info['aborted'] = True
+            stale_uploads.append(chunk_tracker.pop(key))
+    for info in stale_uploads:
+        logger.info("Evicting idle upload %s (%d/%d chunks received)", info['upload_id'], info['received_count'], info['total_chunks'])
+        abort_chunked_upload(info)
+    
+    with image_chunks_lock:
+        stale_ids = [upload_id for upload_id, chunk_info in image_chunks.items()
+                     if now - chunk_info['created_at'] > MAX_IMAGE_AGE]
+        stale_images = [image_chunks.pop(upload_id) for upload_id in stale_ids]
+    for chunk_info in stale_images:
+        logger.info("Evicting uncollected image chunks for %s", chunk_info['image_name'])
+        remove_image_chunk_files(chunk_info)
+
+def prune_buildx_caches():
+    """Remove buildx cache directories that no build has used for BUILDX_CACHE_MAX_AGE"""
+    try:
+        entries = list(os.scandir(BUILDX_CACHE_DIR))
+    except FileNotFoundError:
+        return
+    now = time.time()
+    for entry in entries:
+        # Renamed out of the way under the lock, so a build starting now gets a fresh
+        # directory rather than one that is being deleted
+        with buildx_cache_lock:
+            if (entry.path in buildx_caches_in_use or not entry.is_dir(follow_symlinks=False)
+                    or now - entry.stat().st_mtime <= BUILDX_CACHE_MAX_AGE):
+                continue
+            discarded = f"{entry.path}.{uuid.uuid4().hex[:8]}.discard"
+            try:
+                os.rename(entry.path, discarded)
+            except OSError as e:
+                logger.warning("Failed to prune buildx cache %s: %s", entry.path, e)
+                continue
+        logger.info("Pruning unused buildx cache %s", entry.path)
+        remove_tree(discarded)
+
+def run_eviction_loop():
+    """Evict stale uploads, images and buildx caches every EVICTION_INTERVAL seconds (runs on its own thread)"""
+    while True:
+        time.sleep(EVICTION_INTERVAL)
+        try:
+            evict_stale_uploads()
+        except Exception:
+            logger.exception("Evicting stale uploads failed")
+        try:
+            prune_buildx_caches()
+        except Exception:
+            logger.exception("Pruning buildx caches failed")
+
+threading.Thread(target=run_eviction_loop, daemon=True).start()
+
+
 @app.route("/image/<upload_id>/complete", methods=["POST"])
 def mark_image_download_complete(upload_id):
     """Mark image download as complete and clean up chunks"""
-    if upload_id not in image_chunks:
+    # Remove from tracking first, so a concurrent request can't clean up the same chunks
+    with image_chunks_lock:
+        chunk_info = image_chunks.pop(upload_id, None)
+    if chunk_info is None:
         return jsonify({"error": "Image chunks not found for this upload ID"}), 404
     
-    chunk_info = image_chunks[upload_id]
-    cleanup_count = 0
-    
     # Clean up chunk files
-    for chunk_filename in chunk_info["chunk_files"]:
-        chunk_path = f"./{chunk_filename}"
-        try:
-            if os.path.exists(chunk_path):
-                os.remove(chunk_path)
-                cleanup_count += 1
-                print(f"Cleaned up image chunk: {chunk_filename}")
-        except OSError as e:
-            print(f"Failed to remove chunk {chunk_filename}: {e}")
-    
-    # Remove from tracking
-    del image_chunks[upload_id]
+    cleanup_count = remove_image_chunk_files(chunk_info)
     
     return jsonify({
         "message": f"Image download marked complete, cleaned up {cleanup_count} chunk files",
@@ -509,102 +1506,33 @@ def mark_image_download_complete(upload_id):
 
 def get_built_docker_images():
     """Get list of Docker images built by this server"""
-    try:
-        # List Docker images with our naming pattern
-        cmd = ["docker", "images", "--format", "json", "--filter", "reference=cicd-build-*"]
-        result = subprocess.run(cmd, capture_output=True, text=True)
-        
-        if result.returncode == 0:
-            images = []
-            for line in result.stdout.strip().split('\n'):
-                if line:
-                    try:
-                        image_info = json.loads(line)
-                        # Parse architecture and upload_id from image name
-                        tag_parts = image_info['Repository'].split('-')
-                        if len(tag_parts) >= 4:  # cicd-build-{arch}-{upload_id}
-                            architecture = tag_parts[2]
-                            upload_id_short = tag_parts[3]
-                            images.append({
-                                "name": image_info['Repository'],
-                                "tag": image_info['Tag'],
-                                "architecture": architecture,
-                                "upload_id_short": upload_id_short,
-                                "size": image_info['Size'],
-                                "created": image_info['CreatedSince']
-                            })
-                    except json.JSONDecodeError:
-                        pass
-            return images
-        else:
-            return []
-    except Exception as e:
-        print(f"Error listing Docker images: {e}")
-        return []
-    """Get list of Docker images built by this server"""
-    try:
-        # List Docker images with our naming pattern
-        cmd = ["docker", "images", "--format", "json", "--filter", "reference=cicd-build-*"]
-        result = subprocess.run(cmd, capture_output=True, text=True)
-        
-        if result.returncode == 0:
-            images = []
-            for line in result.stdout.strip().split('\n'):
-                if line:
-                    try:
-                        image_info = json.loads(line)
-                        # Parse architecture and upload_id from image name
-                        tag_parts = image_info['Repository'].split('-')
-                        if len(tag_parts) >= 4:  # cicd-build-{arch}-{upload_id}
-                            architecture = tag_parts[2]
-                            upload_id_short = tag_parts[3]
-                            images.append({
-                                "name": image_info['Repository'],
-                                "tag": image_info['Tag'],
-                                "architecture": architecture,
-                                "upload_id_short": upload_id_short,
-                                "size": image_info['Size'],
-                                "created": image_info['CreatedSince']
-                            })
-                    except json.JSONDecodeError:
-                        pass
-            return images
-        else:
-            return []
-    except Exception as e:
-        print(f"Error listing Docker images: {e}")
-        return []
+    with built_images_lock:
+        return [dict(image) for image in built_images.values()]
 
 @app.route("/status", methods=["GET"])
 def get_status():
     """Get the current status of chunked uploads, extracted directories, built Docker images, and available image chunks"""
     status = {}
-    for upload_key, info in chunk_tracker.items():
+    with chunk_tracker_lock:
+        active_uploads = list(chunk_tracker.items())
+    for upload_key, info in active_uploads:
         status[upload_key] = {
-            "received_chunks": len(info['received_chunks']),
+            "received_chunks": info['received_count'],
             "total_chunks": info['total_chunks'],
-            "progress": f"{len(info['received_chunks'])}/{info['total_chunks']}",
+            "progress": f"{info['received_count']}/{info['total_chunks']}",
+            "missing_chunks": missing_chunks(info),
             "architecture": info['architecture'],
             "original_filename": info['original_filename']
         }
     
-    # List extracted directories
-    extracted_dirs = []
-    for item in os.listdir('.'):
-        if os.path.isdir(item) and not item.startswith('.') and not item == '__pycache__':
-            # Check if it looks like a UUID (extracted directory)
-            try:
-                uuid.UUID(item)
-                extracted_dirs.append(item)
-            except ValueError:
-                pass
-    
     # Get built Docker images
     docker_images = get_built_docker_images()
     
     # Get available image chunks for download
     available_images = {}
-    for upload_id, chunk_info in image_chunks.items():
+    with image_chunks_lock:
+        exported_images = list(image_chunks.items())
+    for upload_id, chunk_info in exported_images:
         available_images[upload_id] = {
             "image_name": chunk_info["image_name"],
             "architecture": chunk_info["architecture"],
@@ -613,9 +1541,12 @@ def get_status():
             "created_at": chunk_info["created_at"]
         }
     
+    with workdirs_lock:
+        extraction_dirs = list(extracted_dirs)
+    
     return jsonify({
         "active_uploads": status,
-        "extracted_directories": extracted_dirs,
+        "extracted_directories": extraction_dirs,
         "docker_images": docker_images,
         "available_image_chunks": available_images
     }), 200
@@ -626,44 +1557,42 @@ def cleanup_temp_files():
     """Clean up any leftover temporary files and extracted directories"""
     cleanup_count = 0
     
-    # Clean up chunk files
-    for filename in os.listdir('.'):
-        if filename.startswith('temp_') and '_chunk_' in filename:
-            try:
-                os.remove(filename)
-                cleanup_count += 1
-            except OSError:
-                pass
-        # Clean up leftover received tar files
-        elif filename.startswith('received_') and filename.endswith('.tar.gz'):
-            try:
-                os.remove(filename)
-                cleanup_count += 1
-            except OSError:
-                pass
-        # Clean up image chunk files
-        elif filename.startswith('image_chunk_') and filename.endswith('.tar'):
-            try:
-                os.remove(filename)
-                cleanup_count += 1
-            except OSError:
-                pass
+    # Abort uploads that are still in progress, stopping their extraction
+    with chunk_tracker_lock:
+        active_uploads = list(chunk_tracker.values())
+        chunk_tracker.clear()
+        completed_uploads.clear()
+    for info in active_uploads:
+        abort_chunked_upload(info)
+        cleanup_count += 1
     
-    # Clean up extracted directories (UUID directories)
-    extracted_cleanup_count = 0
-    for item in os.listdir('.'):
-        if os.path.isdir(item) and not item.startswith('.') and not item == '__pycache__':
-            # Check if it looks like a UUID (extracted directory)
-            try:
-                uuid.UUID(item)
-                import shutil
-                shutil.rmtree(item)
-                extracted_cleanup_count += 1
-                print(f"Removed extracted directory: {item}")
-            except ValueError:
-                pass
-            except OSError as e:
-                print(f"Failed to remove directory {item}: {e}")
+    # Clean up leftover received tar files
+    for tar_file_path in list(received_tars):
+        try:
+            os.remove(tar_file_path)
+            cleanup_count += 1
+        except OSError:
+            pass
+        received_tars.discard(tar_file_path)
+    
+    # Clean up Docker build logs
+    for build_log_path in list(build_logs):
+        try:
+            os.remove(build_log_path)
+            cleanup_count += 1
+        except OSError:
+            pass
+        build_logs.discard(build_log_path)
+    
+    # Clean up image chunk files
+    with image_chunks_lock:
+        exported_images = list(image_chunks.values())
+        image_chunks.clear()
+    for chunk_info in exported_images:
+        cleanup_count += remove_image_chunk_files(chunk_info)
+    
+    # Extraction directories are emptied and returned to the pool by their jobs,
+    # so the ones still in use are left alone here
     
     # Clean up Docker images built by this server
     docker_cleanup_count = 0
@@ -680,26 +1609,29 @@ def cleanup_temp_files():
                         rm_result = subprocess.run(rm_cmd, capture_output=True, text=True)
                         if rm_result.returncode == 0:
                             docker_cleanup_count += 1
-                            print(f"Removed Docker image: {image_id}")
+                            logger.info("Removed Docker image: %s", image_id)
                         else:
-                            print(f"Failed to remove Docker image {image_id}: {rm_result.stderr}")
+                            logger.warning("Failed to remove Docker image %s: %s", image_id, rm_result.stderr)
                     except Exception as e:
-                        print(f"Error removing Docker image {image_id}: {e}")
+                        logger.exception("Error removing Docker image %s", image_id)
     except Exception as e:
-        print(f"Error during Docker cleanup: {e}")
+        logger.exception("Error during Docker cleanup")
     
     # Clear the trackers
-    chunk_tracker.clear()
-    image_chunks.clear()
+    with built_images_lock:
+        built_images.clear()
+    for job_id, future in list(jobs.items()):
+        if future.done():
+            del jobs[job_id]
     
     return jsonify({
-        "message": f"Cleaned up {cleanup_count} temporary files, {extracted_cleanup_count} extracted directories, and {docker_cleanup_count} Docker images",
+        "message": f"Cleaned up {cleanup_count} temporary files and {docker_cleanup_count} Docker images",
         "temp_files_cleaned": cleanup_count,
-        "directories_cleaned": extracted_cleanup_count,
         "docker_images_cleaned": docker_cleanup_count,
         "tracker_cleared": True
     }), 200
 
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5000, debug=True)
\ No newline at end of file
+    # Development only; use gunicorn with gunicorn.conf.py in production
+    app.run(host="0.0.0.0", port=5000, threaded=True)
\ No newline at end of file
@@ -0,0 +1,233 @@
+import hashlib
+import importlib
+import io
+import os
+import sys
+import tarfile
+import tempfile
+import unittest
+
+server = None
+
+def setUpModule():
+    """Import the server from a scratch directory, as it creates its workdirs and staging files in the cwd"""
+    global server, scratch_dir, original_cwd
+    original_cwd = os.getcwd()
+    scratch_dir = tempfile.TemporaryDirectory()
+    os.chdir(scratch_dir.name)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    server = importlib.import_module("server")
+
+def tearDownModule():
+    os.chdir(original_cwd)
+    scratch_dir.cleanup()
+
+class GunicornBody:
+    """Stand-in for gunicorn's request body: read() only, no readinto() and not an io.RawIOBase"""
+    def __init__(self, data):
+        self.data = data
+        self.position = 0
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = len(self.data) - self.position
+        data = self.data[self.position:self.position + size]
+        self.position += len(data)
+        return data
+
+def chunk_headers(filename, chunk, chunk_size=1024):
+    """Headers for the first of two chunks of a raw chunked upload"""
+    return {
+        "X-Architecture": "x64",
+        "X-Chunk-Index": "0",
+        "X-Total-Chunks": "2",
+        "X-Chunk-Size": str(chunk_size),
+        "X-Total-Size": str(chunk_size + 100),
+        "X-Original-Filename": filename,
+        "X-Chunk-Sha256": hashlib.sha256(chunk).hexdigest()
+    }
+
+class ReceiveChunkTest(unittest.TestCase):
+    def test_raw_chunk_from_gunicorn_body(self):
+        chunk_size = 1024
+        chunk = os.urandom(chunk_size)
+        headers = chunk_headers("gunicorn_body.tar", chunk, chunk_size)
+        # gunicorn sets wsgi.input_terminated, so Werkzeug passes its body through unwrapped
+        response = server.app.test_client().post("/data_raw", headers=headers, environ_overrides={
+            "wsgi.input": GunicornBody(chunk),
+            "wsgi.input_terminated": True
+        })
+        self.assertEqual(response.status_code, 200, response.get_data(as_text=True))
+
+        tracker_entry = server.chunk_tracker.pop("gunicorn_body.tar_x64")
+        try:
+            self.assertEqual(tracker_entry['received_count'], 1)
+            self.assertEqual(os.pread(tracker_entry['fd'], chunk_size, 0), chunk)
+        finally:
+            server.abort_chunked_upload(tracker_entry)
+
+    def test_corrupted_retry_of_accepted_chunk_keeps_its_bytes(self):
+        chunk_size = 1024
+        chunk = os.urandom(chunk_size)
+        headers = chunk_headers("corrupted_retry.tar", chunk, chunk_size)
+        client = server.app.test_client()
+        response = client.post("/data_raw", headers=headers, data=chunk)
+        self.assertEqual(response.status_code, 200, response.get_data(as_text=True))
+        corrupted = bytes([chunk[0] ^ 0xff]) + chunk[1:]
+        client.post("/data_raw", headers=headers, data=corrupted)
+
+        tracker_entry = server.chunk_tracker.pop("corrupted_retry.tar_x64")
+        try:
+            self.assertEqual(tracker_entry['received_count'], 1)
+            self.assertEqual(os.pread(tracker_entry['fd'], chunk_size, 0), chunk)
+        finally:
+            server.abort_chunked_upload(tracker_entry)
+
+    def test_chunk_for_aborted_upload_is_refused(self):
+        chunk_size = 1024
+        chunk = os.urandom(chunk_size)
+        headers = chunk_headers("aborted_upload.tar", chunk, chunk_size)
+        client = server.app.test_client()
+        response = client.post("/data_raw", headers=headers, data=chunk)
+        self.assertEqual(response.status_code, 200, response.get_data(as_text=True))
+
+        # A request that looked the entry up just before the abort must not write to its closed file
+        tracker_entry = server.chunk_tracker["aborted_upload.tar_x64"]
+        server.abort_chunked_upload(tracker_entry)
+        last_chunk = os.urandom(100)
+        response = client.post("/data_raw", data=last_chunk,
+                               headers={**chunk_headers("aborted_upload.tar", last_chunk, chunk_size), "X-Chunk-Index": "1"})
+        server.chunk_tracker.pop("aborted_upload.tar_x64")
+        self.assertEqual(response.status_code, 410, response.get_data(as_text=True))
+        self.assertEqual(tracker_entry['received_count'], 1)
+        self.assertIsNone(tracker_entry['fd'])
+        server.close_staging_file(tracker_entry)
+
+class CompletedUploadRetryTest(unittest.TestCase):
+    def test_retry_after_completion_gets_the_upload_job(self):
+        chunk = tar_archive((tar_member("proj/Dockerfile"), b"FROM scratch\n")).getvalue()
+        headers = {**chunk_headers("completed_retry.tar", chunk, len(chunk)),
+                   "X-Total-Chunks": "1", "X-Total-Size": str(len(chunk))}
+        client = server.app.test_client()
+        response = client.post("/data_raw", headers=headers, data=chunk)
+        self.assertEqual(response.status_code, 202, response.get_data(as_text=True))
+        job_id = response.get_json()["job_id"]
+
+        # The 202 was lost, so the sender sends the last chunk again
+        retry = client.post("/data_raw", headers=headers, data=chunk)
+        self.assertEqual(retry.status_code, 202, retry.get_data(as_text=True))
+        self.assertEqual(retry.get_json()["job_id"], job_id)
+        self.assertNotIn("completed_retry.tar_x64", server.chunk_tracker)
+        server.jobs[job_id].result(timeout=10)
+
+class ArchitectureTest(unittest.TestCase):
+    def test_architectures_are_normalized(self):
+        self.assertEqual(server.normalize_architecture("x64, arm64,x64,"), "x64,arm64")
+
+    def test_unsupported_architecture_is_refused_before_upload(self):
+        response = server.app.test_client().post("/data_raw", data=b"", headers={
+            "X-Architecture": "x64,sparc",
+            "X-Original-Filename": "unsupported.tar"
+        })
+        self.assertEqual(response.status_code, 400, response.get_data(as_text=True))
+
+def tar_archive(*members):
+    """Build an uncompressed tar in memory from (TarInfo, data) pairs"""
+    archive = io.BytesIO()
+    with tarfile.open(fileobj=archive, mode="w") as tar:
+        for info, data in members:
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    archive.seek(0)
+    return archive
+
+def tar_member(name, type=tarfile.REGTYPE, linkname=""):
+    info = tarfile.TarInfo(name)
+    info.type = type
+    info.linkname = linkname
+    return info
+
+class ExtractWithoutFilterTest(unittest.TestCase):
+    """Extraction on a Python without tarfile's extraction filters"""
+    def setUp(self):
+        self.extract_dir = tempfile.mkdtemp(dir=".")
+        self.saved_kwargs = server.TAR_EXTRACT_KWARGS
+        server.TAR_EXTRACT_KWARGS = {}
+
+    def tearDown(self):
+        server.TAR_EXTRACT_KWARGS = self.saved_kwargs
+        server.remove_tree(self.extract_dir)
+
+    def extract(self, *members):
+        return server.extract_tar_in_process(tar_archive(*members), self.extract_dir, "r|")
+
+    def test_safe_archive_extracts(self):
+        error = self.extract((tar_member("proj/Dockerfile"), b"FROM scratch\n"),
+                             (tar_member("proj/link", tarfile.SYMTYPE, "Dockerfile"), b""))
+        self.assertIsNone(error)
+        self.assertTrue(os.path.isfile(os.path.join(self.extract_dir, "Dockerfile")))
+
+    def test_escaping_members_are_refused(self):
+        for member in (tar_member("proj/../../escaped"),
+                       tar_member("proj/link", tarfile.SYMTYPE, "/etc"),
+                       tar_member("proj/sub/link", tarfile.SYMTYPE, "../../.."),
+                       tar_member("proj/hard", tarfile.LNKTYPE, "proj/../../outside")):
+            with self.subTest(member=member.name):
+                self.assertIsNotNone(self.extract((member, b"x")))
+        self.assertFalse(os.path.exists("escaped"))
+
+class DownloadImageTest(unittest.TestCase):
+    def setUp(self):
+        self.data = os.urandom(300)
+        for i in range(3):
+            with open(f"image_chunk_range_{i:03d}.tar", "wb") as chunk_file:
+                chunk_file.write(self.data[i * 100:(i + 1) * 100])
+        server.image_chunks["range"] = {
+            "image_name": "cicd-build-x64-range",
+            "chunk_files": [f"image_chunk_range_{i:03d}.tar" for i in range(3)],
+            "chunk_size": 100,
+            "original_size": 300
+        }
+
+    def tearDown(self):
+        server.remove_image_chunk_files(server.image_chunks.pop("range"))
+
+    def get(self, range_header):
+        return server.app.test_client().get("/image/range", headers={"Range": range_header})
+
+    def test_single_range(self):
+        response = self.get("bytes=50-149")
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.data, self.data[50:150])
+
+    def test_unsatisfiable_range(self):
+        self.assertEqual(self.get("bytes=400-").status_code, 416)
+
+    def test_multiple_ranges_get_the_whole_image(self):
+        response = self.get("bytes=0-9,200-209")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, self.data)
+
+class StreamImageTest(unittest.TestCase):
+    def test_missing_docker_is_a_json_error(self):
+        server.image_chunks["no-docker"] = {"image_name": "cicd-build-x64-nodocker", "chunk_files": []}
+        saved_path = os.environ.get("PATH", "")
+        os.environ["PATH"] = ""
+        try:
+            response = server.app.test_client().get("/image/no-docker/stream")
+        finally:
+            os.environ["PATH"] = saved_path
+            server.image_chunks.pop("no-docker")
+        self.assertEqual(response.status_code, 500)
+        self.assertIn("error", response.get_json())
+
+class WorkdirPoolTest(unittest.TestCase):
+    def test_released_workdir_is_pooled_once(self):
+        workdir = server.acquire_workdir("double-release")
+        server.release_workdir(workdir)
+        server.release_workdir(workdir)
+        pooled = list(server.workdir_pool.queue)
+        self.assertEqual(pooled.count(workdir), 1, pooled)
+
+if __name__ == "__main__":
+    unittest.main()
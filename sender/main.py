@@ -1,62 +1,169 @@
 import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import hashlib
+import mmap
 import os
 import config
+import random
 import requests
+import shutil
+import subprocess
 import sys
 import time
 
 # Global verbosity level
 verbosity = 0
 
+# One session for every request, so the connection checks, chunk uploads, retries
+# and job polling reuse kept-alive connections instead of reconnecting each time.
+# Retries are handled by send_request_with_retry
+session = requests.Session()
+session.mount("http://", requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=0))
+session.mount("https://", requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=0))
+
+# Archive extension, the compressors to try, fastest first, and the tar option to
+# fall back on when none of them is installed, for each --codec; the receiver picks
+# its decompressor from the extension. pigz compresses on every core
+CODECS = {
+    "gzip": (".tar.gz", [["pigz", "-p", str(os.cpu_count() or 1)], ["gzip"]], ["-z"]),
+    "zstd": (".tar.zst", [["zstd", "-T0"]], ["--zstd"]),
+    "none": (".tar", [], []),
+}
+
+# Architectures the receiver can build for
+ARCHITECTURES = ["x86", "x64", "arm", "arm64"]
+
 def vprint(message, level=1):
     """Print message only if verbosity level is high enough"""
     global verbosity
     if verbosity >= level:
         print(message)
 
-def split_file(file_path, chunk_size_mb=5):
-    """Split a file into chunks of specified size in MB"""
-    chunk_size_bytes = int(chunk_size_mb * 1024 * 1024)  # Convert MB to bytes
+def compressor_command(codec, level=None):
+    """Return the command line of the first installed compressor for a codec, or None if it has none"""
+    for command in CODECS[codec][1]:
+        if shutil.which(command[0]):
+            return command + ([f"-{level}"] if level else []) + ["-c"]
+    return None
+
+def start_archive(target_folder, compressor, output, tar_options=()):
+    """Start tar, piped through compressor if there is one, writing target_folder to output (returns the processes)"""
+    tar_command = ["tar", "-c", *tar_options, "-f", "-", target_folder]
+    if compressor is None:
+        return [subprocess.Popen(tar_command, stdout=output)]
+    tar = subprocess.Popen(tar_command, stdout=subprocess.PIPE)
+    compress = subprocess.Popen(compressor, stdin=tar.stdout, stdout=output)
+    # Leave the compressor as the pipe's only reader, so tar stops if it fails
+    tar.stdout.close()
+    return [tar, compress]
 
-    chunk_files = []
+def wait_for_archive(processes):
+    """Wait for every process of an archive pipeline, returning True if they all succeeded"""
+    return all([process.wait() == 0 for process in processes])
 
+def create_archive(target_folder, archive_name, compressor, tar_options=()):
+    """Write target_folder to archive_name as a tar piped through compressor, returning True on success"""
+    with open(archive_name, 'wb') as archive:
+        return wait_for_archive(start_archive(target_folder, compressor, archive, tar_options))
+
+def map_file(file_path):
+    """Map a whole file read-only, so every request can read from it without opening or seeking it"""
     with open(file_path, 'rb') as f:
-        chunk_num = 0
-        while True:
-            chunk_data = f.read(chunk_size_bytes)
-            if not chunk_data:
-                break
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+def split_file(mm, chunk_size_mb=5):
+    """Split a mapped file into chunks of specified size in MB, returning (offset, length, SHA-256) for each"""
+    chunk_size_bytes = int(chunk_size_mb * 1024 * 1024)  # Convert MB to bytes
+
+    # Chunks are sent straight from the archive, no .partNNN files are written
+    chunks = []
 
-            chunk_filename = f"{file_path}.part{chunk_num:03d}"
-            with open(chunk_filename, 'wb') as chunk_file:
-                chunk_file.write(chunk_data)
+    # Hash each chunk from a view of the mapped archive, without copying it into a bytes object
+    with memoryview(mm) as view:
+        for offset in range(0, len(mm), chunk_size_bytes):
+            with view[offset:offset + chunk_size_bytes] as chunk_view:
+                # The server verifies each chunk against its SHA-256
+                chunks.append((offset, len(chunk_view), hashlib.sha256(chunk_view).hexdigest()))
+                vprint(f"Chunk {len(chunks) - 1}: {len(chunk_view)} bytes at offset {offset}", 2)
 
-            chunk_files.append(chunk_filename)
-            vprint(f"Created chunk: {chunk_filename} ({len(chunk_data)} bytes)", 2)
-            chunk_num += 1
+    return chunks
 
-    return chunk_files
+def choose_chunk_size(file_size, chunk_size_mb, max_chunks=256, max_chunk_size_mb=64):
+    """Double the chunk size in MB until file_size fits in max_chunks chunks (or the size reaches max_chunk_size_mb)"""
+    # The server places chunk n at n * chunk_size, so the size is fixed per upload;
+    # growing it with the archive keeps the request count from growing linearly
+    while file_size > max_chunks * chunk_size_mb * 1024 * 1024 and chunk_size_mb * 2 <= max_chunk_size_mb:
+        chunk_size_mb *= 2
+    return chunk_size_mb
 
-def send_request_with_retry(url, files=None, data=None, max_retries=3, timeout=30):
-    """Send HTTP request with retry logic"""
+def read_file_blocks(mm, offset=0, length=None, block_size=1024 * 1024):
+    """Yield length bytes of a mapped file from offset (by default all of it) in fixed-size blocks for a streamed request body"""
+    # Slicing the map keeps no file position, so parallel chunks and retries can
+    # all read their own range of the one mapping
+    end = len(mm) if length is None else min(offset + length, len(mm))
+    for position in range(offset, end, block_size):
+        yield mm[position:min(position + block_size, end)]
+
+def retry_delay(attempt, response=None, max_delay=30):
+    """Return the seconds to wait before retrying: jittered exponential backoff, or longer if the server sent Retry-After"""
+    # Jitter keeps many senders (or parallel chunks) from all retrying at the same moment
+    delay = random.uniform(0, min(2 ** attempt, max_delay))
+    if response is not None and response.status_code in (429, 503):
+        try:
+            delay = max(delay, float(response.headers.get("Retry-After", 0)))
+        except ValueError:
+            pass  # An HTTP date rather than seconds, fall back to the backoff
+    return min(delay, max_delay)
+
+def send_request_with_retry(url, files=None, data=None, headers=None, max_retries=3, timeout=30):
+    """Send HTTP request with retry logic (data may be a callable returning a fresh body)"""
     for attempt in range(max_retries):
         try:
-            response = requests.post(url, files=files, data=data, timeout=timeout)
+            body = data() if callable(data) else data
+            response = session.post(url, files=files, data=body, headers=headers, timeout=timeout)
             response.raise_for_status()  # Raise an exception for bad status codes
             return response
         except requests.exceptions.RequestException as e:
             vprint(f"Attempt {attempt + 1} failed: {e}", 1)
             if attempt < max_retries - 1:
-                vprint(f"Retrying in {2 ** attempt} seconds...", 1)
-                time.sleep(2 ** attempt)  # Exponential backoff
+                delay = retry_delay(attempt, e.response)
+                vprint(f"Retrying in {delay:.1f} seconds...", 1)
+                time.sleep(delay)
             else:
                 print("All retry attempts failed.")
                 raise
 
+def send_archive_stream(url, target_folder, compressor, headers, tar_options=(), timeout=30):
+    """POST target_folder as an archive streamed from tar as it is created (not retried, the stream can't be replayed)"""
+    processes = start_archive(target_folder, compressor, subprocess.PIPE, tar_options)
+    archive = processes[-1].stdout
+    try:
+        response = session.post(url, data=iter(lambda: archive.read(1024 * 1024), b""), headers=headers, timeout=timeout)
+    finally:
+        archive.close()
+        archived = wait_for_archive(processes)
+    if not archived:
+        raise RuntimeError("Failed to create tar archive while streaming it")
+    response.raise_for_status()
+    return response
+
+def wait_for_job(job_url, max_interval=30):
+    """Poll a queued build job with exponential backoff until it has finished"""
+    interval = 1
+    while True:
+        response = session.get(job_url, timeout=10)
+        response.raise_for_status()
+        job = response.json()
+        if job.get("status") not in ("queued", "running"):
+            return job
+        vprint(f"Build {job['status']}, checking again in {interval} seconds...", 2)
+        time.sleep(interval)
+        interval = min(interval * 2, max_interval)
+
 def validate_server_connection():
     """Test connection to server"""
     try:
-        response = requests.get(config.server, timeout=10)
+        response = session.get(config.server, timeout=10)
         response.raise_for_status()
         vprint(f"Server connection successful: {response.text.strip()}", 1)
         return True
@@ -65,6 +172,32 @@ def validate_server_connection():
         vprint(f"Please check if the server is running at {config.server}", 1)
         return False
 
+def fetch_upload_config():
+    """Get the server's suggested chunk size and upload concurrency, {} if it has none or None if it can't be reached"""
+    try:
+        response = session.get(config.server.strip("/") + "/config", timeout=10)
+        response.raise_for_status()
+        upload_config = response.json()
+        vprint(f"Server upload config: {upload_config}", 2)
+        return upload_config
+    except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+        print(f"✗ Server connection failed: {e}")
+        vprint(f"Please check if the server is running at {config.server}", 1)
+        return None
+    except (requests.exceptions.RequestException, ValueError) as e:
+        vprint(f"No upload config from server, using defaults: {e}", 1)
+        return {}
+
+def architecture_list(value):
+    """Parse a comma-separated list of architectures for -a"""
+    architectures = [arch.strip() for arch in value.split(",") if arch.strip()]
+    for arch in architectures:
+        if arch not in ARCHITECTURES:
+            raise argparse.ArgumentTypeError(f"invalid choice: '{arch}' (choose from {', '.join(ARCHITECTURES)})")
+    if not architectures:
+        raise argparse.ArgumentTypeError("expected at least one architecture")
+    return architectures
+
 def main():
     global verbosity
     
@@ -72,9 +205,10 @@ def main():
     parser.add_argument("folder",
                         help="Target folder as a relative path to package")
     parser.add_argument("-a", "--architecture",
-                        choices=["x86", "x64", "arm", "arm64"],
-                        default="x64",
-                        help="Target architecture to build for (default: x64)")
+                        type=architecture_list,
+                        default=["x64"],
+                        help="Target architecture(s) to build for, comma-separated (e.g. x64,arm64) to build them "
+                             "concurrently from one upload: x86, x64, arm or arm64 (default: x64)")
     parser.add_argument("-v", "--verbose", 
                         action="count", 
                         default=0,
@@ -82,11 +216,28 @@ def main():
     parser.add_argument("-q", "--quiet", 
                         action="store_true",
                         help="Suppress all output except errors")
+    parser.add_argument("-w", "--wait",
+                        action="store_true",
+                        help="Wait for the server to finish building the image")
+    parser.add_argument("-c", "--codec",
+                        choices=list(CODECS),
+                        default="gzip",
+                        help="Archive compression: gzip, zstd (faster to decompress) or none for a fast LAN (default: gzip)")
+    parser.add_argument("-l", "--level",
+                        type=int,
+                        help="Compression level passed to the compressor, e.g. 1 for speed (default: the compressor's own)")
+    parser.add_argument("-s", "--stream",
+                        action="store_true",
+                        help="Upload the archive while it is created, without writing it to disk (no chunking or retries)")
+    parser.add_argument("-j", "--parallel",
+                        type=int,
+                        help="Number of chunks to upload at once (default: what the server suggests, or 4)")
 
     args = parser.parse_args()
 
     target_folder = args.folder
-    architecture = args.architecture
+    # Several architectures travel as one comma-separated field
+    architecture = ",".join(dict.fromkeys(args.architecture))
     verbosity = args.verbose
     
     # Handle quiet mode
@@ -106,75 +257,145 @@ def main():
     vprint(f"Target architecture: {architecture}", 1)
     vprint(f"Server URL: {config.server}", 2)
 
-    # Test server connection
+    # Test server connection. Fetching the upload config already shows whether the
+    # server is reachable, so the separate ping is only worth its round trip at -vv
     print("Connecting...")
-    if not validate_server_connection():
+    if verbosity >= 2 and not validate_server_connection():
+        sys.exit(1)
+    upload_config = fetch_upload_config()
+    if upload_config is None:
         sys.exit(1)
 
     # Create archive with architecture in filename
-    archive_name = f"data_{architecture}.tar.gz"
-    print("Taring...")
-    vprint(f"Creating archive: {archive_name}", 1)
-
-    # Use tar command (works on Windows with Git Bash or WSL)
-    result = os.system(f"tar -czf {archive_name} {target_folder}")
-    if result != 0:
-        print("✗ Error: Failed to create tar archive. Make sure tar is available on your system.")
-        sys.exit(1)
+    extension, compressors, tar_options = CODECS[args.codec]
+    archive_name = f"data_{architecture.replace(',', '-')}{extension}"
+    compressor = compressor_command(args.codec, args.level)
+    if compressor is not None:
+        tar_options = []
+    elif compressors:
+        # Let tar compress on its own, as bsdtar does without any external program
+        vprint(f"No {' or '.join(command[0] for command in compressors)} found, "
+               f"using tar {' '.join(tar_options)}{' (ignoring --level)' if args.level else ''}", 1)
+    compression = " ".join(compressor or ["tar", *tar_options]) if compressor or tar_options else "none"
 
-    if not os.path.exists(archive_name):
-        print(f"✗ Error: Archive {archive_name} was not created")
-        sys.exit(1)
+    archive_map = None
+    if args.stream:
+        # The archive goes to the server as tar writes it, so its size isn't known
+        file_size = None
+    else:
+        print("Taring...")
+        vprint(f"Creating archive: {archive_name}", 1)
+        vprint(f"Compressor: {compression}", 2)
+
+        # Use tar command (works on Windows with Git Bash or WSL)
+        try:
+            archived = create_archive(target_folder, archive_name, compressor, tar_options)
+        except OSError as e:
+            print(f"✗ Error: {e}")
+            archived = False
+        if not archived:
+            print("✗ Error: Failed to create tar archive. Make sure tar is available on your system.")
+            sys.exit(1)
+
+        vprint(f"✓ Created archive: {archive_name}", 1)
 
-    vprint(f"✓ Created archive: {archive_name}", 1)
+        # Check file size and split if necessary
+        file_size = os.path.getsize(archive_name)
+        vprint(f"Archive size: {file_size / (1024*1024):.2f} MB", 1)
 
-    # Check file size and split if necessary
-    file_size = os.path.getsize(archive_name)
-    vprint(f"Archive size: {file_size / (1024*1024):.2f} MB", 1)
+        # Open the archive once for hashing and every chunk request and retry
+        archive_map = map_file(archive_name)
 
-    server_url = config.server.strip("/") + "/data"
+    server_url = config.server.strip("/") + "/data_raw"
 
     try:
-        if file_size > 5 * 1024 * 1024:  # 5MB in bytes
+        if file_size is None:
+            print("Sending...")
+            vprint("Streaming archive as it is created...", 1)
+            vprint(f"Compressor: {compression}", 2)
+            response = send_archive_stream(server_url, target_folder, compressor, {
+                "Content-Type": "application/octet-stream",
+                "X-Architecture": architecture,
+                "X-Original-Filename": archive_name
+            }, tar_options)
+            vprint(f"✓ Archive streamed successfully", 1)
+            vprint(f"  Server response: {response.text}", 2)
+        elif file_size > 5 * 1024 * 1024:  # 5MB in bytes
             print("Splitting...")
             vprint("Archive is larger than 5MB, splitting into chunks...", 1)
-            chunk_files = split_file(archive_name, chunk_size_mb=0.75)
+            chunk_size_mb = upload_config.get("chunk_size", 0.75 * 1024 * 1024) / (1024 * 1024)
+            chunk_size_mb = choose_chunk_size(file_size, chunk_size_mb)
+            vprint(f"Chunk size: {chunk_size_mb:g} MB", 2)
+            chunks = split_file(archive_map, chunk_size_mb=chunk_size_mb)
 
-            # Send each chunk to the server
+            # Send the chunks to the server several at a time; the server writes each
+            # at its own offset, so they may arrive in any order
+            parallel = max(1, args.parallel or upload_config.get("max_concurrent_chunks", 4))
             print("Sending...")
-            for i, chunk_file in enumerate(chunk_files):
-                vprint(f"Sending chunk {i+1}/{len(chunk_files)}...", 1)
-                with open(chunk_file, "rb") as f:
-                    chunk_data = {
-                        "architecture": architecture,
-                        "chunk_index": str(i),
-                        "total_chunks": str(len(chunk_files)),
-                        "original_filename": archive_name
-                    }
-                    response = send_request_with_retry(server_url,
-                                                     files={"file": f},
-                                                     data=chunk_data)
-                    vprint(f"✓ Chunk {i+1}/{len(chunk_files)} sent successfully", 1)
-                    vprint(f"  Server response: {response.text}", 2)
-
-            # Clean up chunk files
-            for chunk_file in chunk_files:
-                if os.path.exists(chunk_file):
-                    os.remove(chunk_file)
-                    vprint(f"Cleaned up chunk: {chunk_file}", 2)
+            vprint(f"Sending {len(chunks)} chunks, {parallel} at a time...", 1)
+            response = None
+            # Headers shared by every chunk; each request gets its own copy, as the
+            # chunks are sent from several threads at once
+            upload_headers = {
+                "Content-Type": "application/octet-stream",
+                "X-Architecture": architecture,
+                "X-Total-Chunks": str(len(chunks)),
+                "X-Chunk-Size": str(int(chunk_size_mb * 1024 * 1024)),
+                "X-Total-Size": str(file_size),
+                "X-Original-Filename": archive_name
+            }
+            with ThreadPoolExecutor(max_workers=parallel) as executor:
+                futures = {}
+                for i, (chunk_offset, chunk_length, chunk_digest) in enumerate(chunks):
+                    chunk_headers = {**upload_headers, "X-Chunk-Index": str(i), "X-Chunk-Sha256": chunk_digest}
+                    future = executor.submit(send_request_with_retry, server_url,
+                                             data=lambda offset=chunk_offset, length=chunk_length:
+                                                 read_file_blocks(archive_map, offset, length),
+                                             headers=chunk_headers)
+                    futures[future] = i
+                try:
+                    for future in as_completed(futures):
+                        i = futures[future]
+                        chunk_response = future.result()
+                        vprint(f"✓ Chunk {i+1}/{len(chunks)} sent successfully", 1)
+                        vprint(f"  Server response: {chunk_response.text}", 2)
+                        # Whichever chunk completes the upload gets the queued build's response
+                        if response is None or chunk_response.status_code == 202:
+                            response = chunk_response
+                except Exception:
+                    # Don't start the remaining chunks once one has failed for good
+                    for future in futures:
+                        future.cancel()
+                    raise
         else:
             print("Sending...")
             vprint("Archive is under 5MB, sending as single file...", 1)
             # Send the archive to the server
-            with open(archive_name, "rb") as f:
-                response = send_request_with_retry(server_url,
-                                                 files={"file": f},
-                                                 data={"architecture": architecture})
-                vprint(f"✓ File sent successfully", 1)
-                vprint(f"  Server response: {response.text}", 2)
+            response = send_request_with_retry(server_url,
+                                               data=lambda: read_file_blocks(archive_map),
+                                               headers={
+                                                   "Content-Type": "application/octet-stream",
+                                                   "X-Architecture": architecture,
+                                                   "X-Original-Filename": archive_name
+                                               })
+            vprint(f"✓ File sent successfully", 1)
+            vprint(f"  Server response: {response.text}", 2)
 
         print("Complete!")
         vprint("✓ Upload completed successfully!", 1)
+        if response.status_code == 202:
+            job_id = response.json().get("job_id")
+            job_url = f"{config.server.strip('/')}/jobs/{job_id}"
+            if args.wait:
+                print("Building...")
+                job = wait_for_job(job_url)
+                if job.get("status") != "completed":
+                    print(f"✗ Build failed: {job.get('message') or job.get('error')}")
+                    sys.exit(1)
+                print("Built!")
+                vprint(f"✓ {job.get('message')}", 1)
+            else:
+                vprint(f"Build queued, check {job_url} for its status", 1)
 
     except requests.exceptions.RequestException as e:
         print(f"✗ Error sending file to server: {e}")
@@ -183,6 +404,8 @@ def main():
         print(f"✗ Unexpected error: {e}")
         sys.exit(1)
     finally:
+        if archive_map is not None:
+            archive_map.close()
         # Clean up original archive
         if os.path.exists(archive_name):
             os.remove(archive_name)